@@ -9,14 +9,16 @@ sys.path.append('../')
 from hecrasio.core import *
 from hecrasio.qaqc import *
 from hecrasio.s3tools import *
+from hecrasio.runner import run_qaqc, write_records
 from botocore.exceptions import ClientError
 from papermill.exceptions import PapermillExecutionError
 
-# [usage] python PostProcessor.py jobID procDirID > jobID.out
+# [usage] python PostProcessor.py jobID procDirID [report] > jobID.out
 
 def main():
     jobID = sys.argv[1] # JobID to process
     procDirID = sys.argv[2] # Integer for naming processing folder if required
+    report = len(sys.argv) > 3 and sys.argv[3] == 'report' # Run the QAQC notebook rather than headless checks
     projID = '_'.join([jobID.split('_')[0], jobID.split('_')[1]])
     projID.lower()
 
@@ -76,20 +78,29 @@ def main():
     rasmap  = str(wkdir/"{}.rasmap")
     rasPlan = str(wkdir/"{}")
     qaqcNB  = str(wkdir/"{}.ipynb".format(jobID))
+    qaqcJSON = str(wkdir/"{}.json".format(jobID))
 
-    # Run QAQC Notebook --> Uncomment for production
+    # Run headless QAQC checks, the notebook is only run when a report is requested
+    if not report:
+        record = run_qaqc(s3_model_output)
+        write_records([record], qaqcJSON)
+        if record['Global Errors']:
+            with open(os.path.join(errs, '{}.txt'.format(jobID)), 'a') as f:
+                f.write("QAQC Errors {}\n".format(record['Global Errors']))
 
-    try:
-        notebook = pm.execute_notebook(nb, qaqcNB, parameters={'hecrasio_path':hecrasio_path, 'model_s3path' : s3_model_output})
-        pipe = subprocess.Popen(['jupyter', 'nbconvert', qaqcNB], stdout=subprocess.PIPE)
-    except PapermillExecutionError as e:
-        with open(os.path.join(errs, '{}.txt'.format(jobID)), 'a') as f:
-            f.write("Notebook Error {}\n".format(e))
-        raise
-    except RuntimeError:
-        sleep(60)
-        notebook = pm.execute_notebook(nb, qaqcNB, parameters={'hecrasio_path':hecrasio_path, 'model_s3path' : s3_model_output})
-        pipe = subprocess.Popen(['jupyter', 'nbconvert', qaqcNB], stdout=subprocess.PIPE)
+    # Run QAQC Notebook --> Uncomment for production
+    else:
+        try:
+            notebook = pm.execute_notebook(nb, qaqcNB, parameters={'hecrasio_path':hecrasio_path, 'model_s3path' : s3_model_output})
+            pipe = subprocess.Popen(['jupyter', 'nbconvert', qaqcNB], stdout=subprocess.PIPE)
+        except PapermillExecutionError as e:
+            with open(os.path.join(errs, '{}.txt'.format(jobID)), 'a') as f:
+                f.write("Notebook Error {}\n".format(e))
+            raise
+        except RuntimeError:
+            sleep(60)
+            notebook = pm.execute_notebook(nb, qaqcNB, parameters={'hecrasio_path':hecrasio_path, 'model_s3path' : s3_model_output})
+            pipe = subprocess.Popen(['jupyter', 'nbconvert', qaqcNB], stdout=subprocess.PIPE)
         
 
 
@@ -153,7 +164,7 @@ def main():
     del local_tiff # unlock  
 
     # Clean tmp files & copy results to s3
-    save_files = clean_workspace(wkdir, jobID)
+    save_files = clean_workspace(wkdir, jobID, ['.html', '.ipynb', '.csv', '.tif', '.vrt', '.json'])
     #assert len(save_files) == 5
 
     for s in save_files:
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ### Wet/dry chunk codec benchmark for the heatmap pipeline
+# Compares file size, write throughput and read + accumulate throughput of
+# int8 and bit-packed wet/dry chunks for each codec in hecrasio.heatmap.CODECS.
+# Codecs needing hdf5plugin are skipped when it is not installed.
+
+# [usage] python benchmarks/heatmap_codecs.py [rows] [cols] [events]
+
+import os
+import sys
+import shutil
+import tempfile
+from time import perf_counter
+import numpy as np
+import h5py
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hecrasio.heatmap import CODECS, codec_options, write_wet_chunk, read_wet_chunk, register_hdf5_filters
+
+
+def wet_dry_events(rows: int, cols: int, events: int, seed: int = 0) -> list:
+    """
+    Spatially coherent wet/dry grids: a smooth terrain flooded to a different
+    level per event, so wet areas are contiguous as in real WSE grids.
+    """
+    rng = np.random.RandomState(seed)
+    coarse = rng.rand(rows // 64 + 2, cols // 64 + 2)
+    terrain = np.kron(coarse, np.ones((64, 64)))[:rows, :cols] + rng.rand(rows, cols) * 0.05
+    return [terrain < level for level in np.linspace(0.2, 0.6, events)]
+
+
+def run(rows: int = 2000, cols: int = 2000, events: int = 8) -> list:
+    grids = wet_dry_events(rows, cols, events)
+    weights = np.full(events, 1 / events)
+    raw_mb = rows * cols * events / 1e6
+    tmp = tempfile.mkdtemp()
+    results = []
+    try:
+        for codec in CODECS:
+            for packed in (False, True):
+                try:
+                    codec_options(codec)
+                except ImportError:
+                    continue
+                paths = [os.path.join(tmp, '{}_{}_{}.hdf'.format(codec.replace(':', '-'), packed, i))
+                         for i in range(events)]
+
+                start = perf_counter()
+                for path, grid in zip(paths, grids):
+                    with h5py.File(path, 'w') as hf:
+                        write_wet_chunk(hf, 'chunk0', grid, packed, codec)
+                write_s = perf_counter() - start
+
+                start = perf_counter()
+                data = np.zeros((rows, cols), dtype=np.float64)
+                for path, weight in zip(paths, weights):
+                    with h5py.File(path, 'r') as hf:
+                        np.add(data, weight, out=data, where=read_wet_chunk(hf['chunk0']))
+                read_s = perf_counter() - start
+
+                assert np.allclose(data, sum(w * g for w, g in zip(weights, grids)))
+                size_mb = sum(os.path.getsize(p) for p in paths) / 1e6
+                results.append((codec, packed, size_mb, raw_mb / write_s, raw_mb / read_s))
+                for p in paths:
+                    os.remove(p)
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def main():
+    rows, cols, events = [int(a) for a in sys.argv[1:4]] if len(sys.argv) > 3 else (2000, 2000, 8)
+    register_hdf5_filters()
+    print('{} events of {} x {} cells ({:.0f} million flags)\n'.format(events, rows, cols,
+                                                                        rows * cols * events / 1e6))
+    print('{0: <12} {1: <7} {2: >10} {3: >16} {4: >16}'.format('Codec', 'Packed', 'Size (MB)',
+                                                               'Write (Mflag/s)', 'Read (Mflag/s)'))
+    print('-' * 65)
+    for codec, packed, size_mb, write_rate, read_rate in run(rows, cols, events):
+        print('{0: <12} {1: <7} {2: >10.2f} {3: >16.0f} {4: >16.0f}'.format(codec, str(packed), size_mb,
+                                                                            write_rate, read_rate))
+
+
+if __name__ == '__main__':
+    main()
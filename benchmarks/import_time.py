@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ### Import time benchmark for hecrasio modules
+# Times each import in a fresh interpreter and checks that heavy dependencies
+# and S3 clients are not loaded until first use.
+
+# [usage] python benchmarks/import_time.py [repeats] [max_core_seconds]
+
+import os
+import sys
+import json
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['hecrasio.core', 'hecrasio.heatmap', 'hecrasio.qaqc']
+
+# Must not be imported by `import hecrasio.core`
+HEAVY = ['geopandas', 'pandas', 'rasterio', 'gdal', 'osgeo', 'matplotlib', 'boto3', 'botocore', 'h5py',
+         'shapely', 'scipy', 'psutil']
+
+PROBE = """
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import {module}
+elapsed = perf_counter() - start
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy, 's3': sys.modules['hecrasio.lazy']._s3 is not None}}))
+"""
+
+
+def time_import(module: str, repeats: int = 5) -> dict:
+    """Median import time of a module over fresh interpreters, with the heavy modules it loaded"""
+    results = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+                             cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if out.returncode != 0:
+            return {'seconds': None, 'heavy': [], 's3': False, 'error': out.stderr.strip().split('\n')[-1]}
+        results.append(json.loads(out.stdout.strip().split('\n')[-1]))
+    return {'seconds': median(r['seconds'] for r in results), 'heavy': results[-1]['heavy'],
+            's3': results[-1]['s3'], 'error': None}
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    max_core_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.25
+
+    print('{0: <20} {1: >10}  {2}'.format('Module', 'Seconds', 'Heavy modules loaded'))
+    print('-' * 79)
+    timings = {}
+    for module in MODULES:
+        timings[module] = time_import(module, repeats)
+        t = timings[module]
+        if t['error']:
+            print('{0: <20} {1: >10}  {2}'.format(module, 'failed', t['error']))
+        else:
+            print('{0: <20} {1: >10.3f}  {2}'.format(module, t['seconds'], ', '.join(t['heavy']) or '-'))
+
+    core = timings['hecrasio.core']
+    assert core['error'] is None, 'Failed to import hecrasio.core: {}'.format(core['error'])
+    assert not core['heavy'], 'hecrasio.core imported {}'.format(core['heavy'])
+    assert not core['s3'], 'hecrasio.core created an S3 resource at import'
+    assert core['seconds'] < max_core_seconds, \
+        'hecrasio.core took {:.3f}s to import, expected under {}s'.format(core['seconds'], max_core_seconds)
+    print('\nhecrasio.core imports in {:.3f}s without heavy dependencies'.format(core['seconds']))
+
+
+if __name__ == '__main__':
+    main()
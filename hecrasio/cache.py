@@ -0,0 +1,163 @@
+"""
+PFRA Module for caching S3 objects on local disk.
+
+Objects are keyed by bucket, key and ETag so that a changed object is never
+served stale, and the least recently used objects are evicted once the cache
+exceeds its size cap. The cache is safe to share between processes, e.g. the
+P1/P2/P3 processing directories on one machine.
+
+Configure with the HECRASIO_CACHE_DIR and HECRASIO_CACHE_GB environment variables.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+import pathlib as pl
+from hecrasio.lazy import get_s3
+
+CACHE_DIR = os.environ.get('HECRASIO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.hecrasio_cache'))
+CACHE_GB = float(os.environ.get('HECRASIO_CACHE_GB', 20))
+
+# Objects used within this many seconds are never evicted
+MIN_AGE = 60
+
+
+class FileLock:
+    """
+    Cross-process lock held by exclusively creating a lock file.
+    Lock files older than stale seconds are assumed abandoned and removed.
+    """
+
+    def __init__(self, path: str, timeout: float = 600, stale: float = 300):
+        self._path = path
+        self._timeout = timeout
+        self._stale = stale
+        self._fd = None
+
+    def __enter__(self):
+        start = time.time()
+        while True:
+            try:
+                self._fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self._path) > self._stale:
+                        os.remove(self._path)
+                        continue
+                except OSError:
+                    continue
+                if time.time() - start > self._timeout:
+                    raise TimeoutError('Unable to acquire lock {}'.format(self._path))
+                time.sleep(0.05)
+
+    def refresh(self):
+        """Marks a lock held for longer than stale seconds as still in use"""
+        os.utime(self._path)
+
+    def __exit__(self, *args):
+        os.close(self._fd)
+        os.remove(self._path)
+
+
+class ObjectCache:
+    """
+    On-disk cache of S3 objects keyed by bucket, key and ETag with
+    least recently used eviction once max_gb is exceeded.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_gb: float = CACHE_GB):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_gb * 1e9
+        self._lock_path = os.path.join(cache_dir, '.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        """Local cache directory"""
+        return self._cache_dir
+
+    def local_path(self, bucket: str, key: str, etag: str) -> str:
+        """Cache file path for an object version, keeping the original file name"""
+        digest = hashlib.sha1('{}/{}/{}'.format(bucket, key, etag).encode()).hexdigest()
+        return os.path.join(self._cache_dir, '{}_{}'.format(digest[:16], pl.PurePosixPath(key).name))
+
+    def get(self, obj) -> str:
+        """
+        Returns a local path to the contents of a boto3 s3.Object,
+        downloading it only if this version is not already cached.
+        """
+        path = self.local_path(obj.bucket_name, obj.key, obj.e_tag.strip('"'))
+        with FileLock(self._lock_path):
+            if os.path.exists(path):
+                os.utime(path)
+                return path
+
+        # Download outside of the lock, concurrent downloads of the same object are harmless
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir, suffix='.part')
+        os.close(fd)
+        try:
+            obj.download_file(tmp)
+            with FileLock(self._lock_path):
+                os.replace(tmp, path)
+                self.evict()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
+
+    def evict(self) -> None:
+        """Removes least recently used objects until the cache is under its size cap"""
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.part'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if now - mtime < MIN_AGE:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # Open elsewhere (Windows), try again on the next eviction
+                pass
+
+    def clear(self) -> None:
+        """Removes all cached objects"""
+        with FileLock(self._lock_path):
+            for entry in os.scandir(self._cache_dir):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+
+_cache = None
+
+
+def get_cache() -> ObjectCache:
+    """Returns the shared object cache, created on first use"""
+    global _cache
+    if _cache is None:
+        _cache = ObjectCache()
+    return _cache
+
+
+def cached_object(obj) -> str:
+    """Returns a local path to a boto3 s3.Object through the shared cache"""
+    return get_cache().get(obj)
+
+
+def cached_s3_path(s3path: str) -> str:
+    """Returns a local path to an s3://bucket/key object through the shared cache"""
+    path_parts = pl.PurePosixPath(s3path.replace('s3://', '')).parts
+    obj = get_s3().Object(bucket_name=path_parts[0], key='/'.join(path_parts[1:]))
+    return cached_object(obj)
@@ -2,23 +2,27 @@
 PFRA Module for working with HEC-RAS model files
 """
 
+import os
 import pathlib as pl
 import zipfile
 import io
-import geopandas as gpd
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import rasterio
-import gdal
-gdal.UseExceptions()
+from hecrasio.streams import S3ObjectFile, zip_member_file, iter_zip_member
+from hecrasio.cache import cached_object
+from hecrasio.lazy import LazyModule, LazyS3, get_s3
+from hecrasio.rasters import open_raster
 
-try:
-    import boto3
+# Heavy dependencies are imported on first use
+np = LazyModule('numpy')
+gpd = LazyModule('geopandas')
+pd = LazyModule('pandas')
+rasterio = LazyModule('rasterio', 'rasterio.crs')
+gdal = LazyModule('gdal', on_import=lambda gdal: gdal.UseExceptions())
+boto3 = LazyModule('boto3')
 
-    resource = boto3.resource('s3')
-    s3 = resource
-except ModuleNotFoundError as e:
-    print('Verify boto3 is installed and credentials are stored, {}'.format(e))
+# The shared S3 resource, created on first use
+s3 = resource = LazyS3()
 
 
 class ResultsZip:
@@ -26,29 +30,35 @@ class ResultsZip:
     HEC-RAS Model Data
     Files (currently) must be read in from a .zip file.
     PFRA set to false if not a StarII study
+    Set stream to true to read S3 files in place with range requests rather
+    than downloading them, only the zip directory and requested members are fetched
     """
 
-    def __init__(self, path: str, require_prj: bool = True, pfra: bool = True):
+    def __init__(self, path: str, require_prj: bool = True, pfra: bool = True, stream: bool = False):
         assert 'zip' in path, "Model files must be stored in a .zip file"
         self._abspath = path
         self._pure_path = pl.Path(path)
         self._pfra = pfra
+        self._stream = stream
+        self._hdf_file = None
 
         def get_s3_data(file_type):
             """
             If path starts with s3 then the code will run from s3 file, otherwise path is expected
             to be a string path to a local model.
             """
-            obj = s3.Object(bucket_name=self._pure_path.parts[1],
+            obj = get_s3().Object(bucket_name=self._pure_path.parts[1],
                             key='/'.join(self._pure_path.parts[2:])
                             )
-            if file_type == ".zip":
-                buffer = io.BytesIO(obj.get()["Body"].read())
-                return zipfile.ZipFile(buffer)
+            if file_type == ".zip" and self._stream:
+                return zipfile.ZipFile(S3ObjectFile(obj))
+            elif file_type == ".zip":
+                return zipfile.ZipFile(cached_object(obj))
+            elif file_type == ".hdf" and self._stream:
+                self._hdf_file = S3ObjectFile(obj)
+                return self._pure_path.parts[-1]
             elif file_type == ".hdf":
-                out_file = './'+self._pure_path.parts[-1]
-                obj.download_file(out_file)
-                return out_file
+                return cached_object(obj)
             else:
                 print("File type failed")
 
@@ -134,6 +144,38 @@ class ResultsZip:
         """
         return self._contents
 
+    def open(self, name: str):
+        """
+        Returns a seekable, read-only file object for a file in the model
+        without extracting it to disk. Zipped files must be stored
+        (uncompressed) to be read in place.
+        """
+        if hasattr(self, '_zipfile'):
+            return zip_member_file(self._zipfile, name)
+        elif self._hdf_file is not None:
+            return self._hdf_file
+        else:
+            return open(self._hdf, 'rb')
+
+    def read(self, name: str, max_workers: int = 8) -> bytes:
+        """
+        Returns the contents of a zipped file. Streamed models fetch the
+        file from S3 in parallel range requests.
+        """
+        return b''.join(iter_zip_member(self._zipfile, name, max_workers=max_workers))
+
+    def extract(self, name: str, path: str = '.', max_workers: int = 8) -> str:
+        """
+        Extracts a zipped file under path, returning the extracted file path.
+        Streamed models fetch the file from S3 in parallel range requests.
+        """
+        out_file = os.path.join(path, *pl.PurePosixPath(name).parts)
+        os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+        with open(out_file, 'wb') as f:
+            for chunk in iter_zip_member(self._zipfile, name, max_workers=max_workers):
+                f.write(chunk)
+        return out_file
+
 class RasModel(object):
     '''
     This object holds information for the files stored in a hec-ras zip file used for STARRII PFRA study.
@@ -148,9 +190,8 @@ class RasModel(object):
             path_parts = pl.PurePosixPath(self.s3path).parts
             bucket = path_parts[1]
             key = '/'.join(path_parts[2:])
-            obj = s3.Object(bucket_name=bucket, key=key)
-            buffer = io.BytesIO(obj.get()["Body"].read())
-            return zipfile.ZipFile(buffer)
+            obj = get_s3().Object(bucket_name=bucket, key=key)
+            return zipfile.ZipFile(cached_object(obj))
 
         self.s3path      = path
         self.name        = str(pl.PurePosixPath(self.s3path).name).replace('.zip','')
@@ -218,8 +259,12 @@ class PointData:
         return rasterio.crs.CRS.from_string(gdf_crs)
     
 class GridObject:
+    """
+    A single band tiff, local or on s3. S3 tiffs are read as set by access
+    (see hecrasio.rasters), call close to free an in-memory copy.
+    """
 
-    def __init__(self, tiff:str):
+    def __init__(self, tiff:str, access: str = None):
         self._tiff          = tiff
         self._posix_path    = pl.PurePosixPath(self._tiff)
         self._tiff_name     = self._posix_path.name
@@ -234,17 +279,13 @@ class GridObject:
             
         def read_from_s3(self) -> 'gdal objects':
             assert not self._is_local, 'Tiff must be on s3 to use this function'
-            s3 = boto3.resource('s3')
-            s3Obj = s3.Object(self._bucket, self._prefix)
-            image_data = BytesIO(s3Obj.get()['Body'].read())
-            tif_inmem = "/vsimem/data.tif" #Virtual Folder to Store Data
-            gdal.FileFromMemBuffer(tif_inmem, image_data.read())
-            src = gdal.Open(tif_inmem)  
-            return src.GetRasterBand(1), src.GetGeoTransform(), src
+            s3Obj = get_s3().Object(self._bucket, self._prefix)
+            self._raster = open_raster(s3Obj, access)
+            return self._raster.rb, self._raster.gt, self._raster.src
         
         def read_from_local(self) -> 'gdal objects':
-            src = gdal.Open(self._tiff)  
-            return src.GetRasterBand(1), src.GetGeoTransform(), src
+            self._raster = open_raster(self._tiff)
+            return self._raster.rb, self._raster.gt, self._raster.src
             
         if self._is_local:
             self._bucket, self._prefix = None, None
@@ -254,6 +295,11 @@ class GridObject:
             self._bucket = self._posix_path.parts[1]
             self._prefix = '/'.join(self._posix_path.parts[2:]) 
             self._rasterBand, self._geoTrans, self._src = read_from_s3(self)
+
+    def close(self):
+        """Closes the tiff, freeing an in-memory copy"""
+        self._rasterBand, self._src = None, None
+        self._raster.close()
             
     @property
     def posix_path(self):
@@ -324,43 +370,83 @@ def s3List(bucketName, prefixName, nameSelector, fileformat):
         
     return pathsList
 
-def query_gdf(gdf: gpd.geodataframe, gt: any, rb: any, point_id:str) -> dict:
+def sample_points(gdf: 'gpd.GeoDataFrame', gt: any, rb: any, point_id: str = None) -> 'pd.DataFrame':
+    """
+    Samples a raster band at every point in a geodataframe. Pixel indices are
+        computed for all points at once and points are grouped by raster block
+        so that each block holding points is read exactly once.
+    :param gdf: Points in the raster projection
+    :param gt: GDAL geotransform
+    :param rb: GDAL raster band
+    :param point_id: Column used to index the result, positional by default
+    :return: DataFrame with the pixel value and out_of_bounds and nodata masks for each point
+    """
+    xy = np.array([(p.x, p.y) for p in gdf.geometry], dtype=np.float64).reshape(-1, 2)
+    px = np.floor((xy[:, 0] - gt[0]) / gt[1]).astype(np.int64)
+    py = np.floor((xy[:, 1] - gt[3]) / gt[5]).astype(np.int64)
+    out_of_bounds = (px < 0) | (px >= rb.XSize) | (py < 0) | (py >= rb.YSize)
+    values = np.full(len(xy), np.nan)
+
+    # Group points by the raster block they fall in
+    bx, by = rb.GetBlockSize()
+    inside = np.flatnonzero(~out_of_bounds)
+    block_row, block_col = py[inside] // by, px[inside] // bx
+    blocks, block_idx = np.unique(np.stack([block_row, block_col], axis=1), axis=0, return_inverse=True)
+    block_idx = block_idx.ravel()
+    order = np.argsort(block_idx, kind='stable')
+    splits = np.cumsum(np.bincount(block_idx, minlength=len(blocks)))[:-1]
+
+    for (row, col), members in zip(blocks, np.split(inside[order], splits)):
+        x0, y0 = col * bx, row * by
+        block = rb.ReadAsArray(int(x0), int(y0), int(min(bx, rb.XSize - x0)), int(min(by, rb.YSize - y0)))
+        values[members] = block[py[members] - y0, px[members] - x0]
+
+    no_data_value = rb.GetNoDataValue()
+    nodata = ~out_of_bounds & (values == no_data_value) if no_data_value is not None else np.zeros(len(xy), bool)
+    index = gdf[point_id].values if point_id is not None else None
+    return pd.DataFrame({'value': values, 'out_of_bounds': out_of_bounds, 'nodata': nodata}, index=index)
+
+def query_gdf(gdf: 'gpd.GeoDataFrame', gt: any, rb: any, point_id:str) -> dict:
     """
     Return point: pixel value pair for a given row in geodataframe
     """
-    results={}
-    for idx in gdf.index:
-        pointID = gdf[point_id].iloc[idx]
-        x, y = gdf.iloc[idx].geometry.x, gdf.iloc[idx].geometry.y
-        px = int((x-gt[0]) / gt[1])   
-        py = int((y-gt[3]) / gt[5])  
-        try:
-            pixel_value = rb.ReadAsArray(px,py,1,1)[0][0]
-            results[pointID] = pixel_value
-        except TypeError as e:
-            results[pointID] = 'Error, verify projection is correct and Point is whithini Tiff bounds'
-            
-    return results
+    samples = sample_points(gdf, gt, rb, point_id)
+    results = samples['value'].astype(object)
+    results[samples['out_of_bounds']] = 'Error, verify projection is correct and Point is whithini Tiff bounds'
+    return results.to_dict()
 
 
-def extract_values_at_points(points:gpd.geodataframe.GeoDataFrame, tiffs:list) -> pd.DataFrame:
-    """Identifies raster values at a given series of points returning a DataFrame."""
-    results={}
+def extract_values_at_points(points:'gpd.GeoDataFrame', tiffs:list, point_id:str=None,
+                             max_workers:int=4, out_file:str=None) -> 'pd.DataFrame':
+    """
+    Identifies raster values at a given series of points returning a DataFrame
+        of points x tiffs. Tiffs are sampled concurrently with a bounded thread
+        pool, each writing its column into a preallocated float32 matrix.
+        Out of bounds and nodata values are NaN.
+    :param points: Points in the raster projection
+    :param tiffs: Local or s3 paths to the rasters, e.g. WSE grids for each event
+    :param point_id: Column used to index the result, positional by default
+    :param max_workers: Number of rasters sampled at once
+    :param out_file: Optional parquet file to write the result to (requires pyarrow or fastparquet)
+    """
+    values = np.full((len(points), len(tiffs)), np.nan, dtype=np.float32)
 
-    for tif in tiffs:
-        tif = GridObject(tif)
-        results[tif.tiff_name.strip('.tif')] =  query_gdf(points, points.index, tif.gt, tif.rb)
-        
-    i=0
-    for k, v in results.items():
-        testd = [(list(d.keys())[0], list(d.values())[0]) for d in v]
-        if i ==0:
-            df = pd.DataFrame.from_records(testd).set_index(0).rename(columns={1:k})
-            i+=1
-        else:
-            tmp = pd.DataFrame.from_records(testd).set_index(0).rename(columns={1:k})
-            df = pd.concat([df,tmp], axis=1)
-    
+    def sample_tiff(j):
+        tif = GridObject(tiffs[j])
+        try:
+            samples = sample_points(points, tif.gt, tif.rb)
+            valid = ~(samples['out_of_bounds'].values | samples['nodata'].values)
+            values[valid, j] = samples['value'].values[valid]
+        finally:
+            tif.close()
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        list(pool.map(sample_tiff, range(len(tiffs))))
+
+    index = points[point_id].values if point_id is not None else None
+    df = pd.DataFrame(values, index=index, columns=[pl.PurePosixPath(t).stem for t in tiffs])
+    if out_file is not None:
+        df.to_parquet(out_file)
     return df
 
 def pull_result_paths(model):
@@ -3,20 +3,28 @@ PFRA Module for creating heatmap tifs.
 """
 
 import os
-import psutil
-import boto3
-import rasterio
-import gdal
-import h5py
-from shapely.geometry import Polygon
+import json
+from abc import ABC, abstractmethod
 from glob import glob
 from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from itertools import islice
 from io import BytesIO
-import numpy as np
-from rasterio.mask import mask
+from hecrasio.cache import FileLock, cached_object
+from hecrasio.lazy import LazyModule, LazyS3, get_s3
+from hecrasio.rasters import open_raster
 
-gdal.UseExceptions()
-s3 = boto3.resource("s3")
+# Heavy dependencies are imported on first use
+psutil = LazyModule("psutil")
+boto3 = LazyModule("boto3")
+rasterio = LazyModule("rasterio", "rasterio.mask")
+gdal = LazyModule("gdal", on_import=lambda gdal: gdal.UseExceptions())
+h5py = LazyModule("h5py")
+np = LazyModule("numpy")
+shapely_geometry = LazyModule("shapely.geometry")
+
+# The shared S3 resource, created on first use
+s3 = LazyS3()
 
 
 def s3List(bucketName: str, prefixName: str, nameSelector: str, fileformat: str) -> list:
@@ -47,57 +55,116 @@ def s3List(bucketName: str, prefixName: str, nameSelector: str, fileformat: str)
 
 
 def getTifData_S3(s3path):
-    """Read a raster from S3 into memory and get attributes"""
-    s3 = boto3.resource("s3")
+    """
+    Read a raster from S3 through the local cache and get attributes.
+    For parallel threads or in-memory and /vsis3/ reads see hecrasio.rasters.open_raster.
+    """
     if isinstance(s3path, str):
         bucket_name = s3path.split(r"s3://")[1].split(r"/")[0]
         key = s3path.split(r"{}/".format(bucket_name))[1]
-        s3tif = s3.Object(bucket_name=bucket_name, key=key)
-        image_data = BytesIO(s3tif.get()["Body"].read())
+        s3tif = get_s3().Object(bucket_name=bucket_name, key=key)
     else:
-        image_data = BytesIO(s3path.get()["Body"].read())
-    tif_inmem = "/vsimem/data.tif"  # Virtual Folder to Store Data
-    gdal.FileFromMemBuffer(tif_inmem, image_data.read())
-    src = gdal.Open(tif_inmem)
+        s3tif = s3path
+    src = gdal.Open(cached_object(s3tif))
     rb, gt = src.GetRasterBand(1), src.GetGeoTransform()
     null_value = rb.GetNoDataValue()
     return rb, gt, src, null_value
 
 
-def bool_wse_to_hdf(wse_grid: str, model_run_id: str, h5: str, n_row_slices: int):
+def getTifData(tif):
+    """Opens a raster on S3 (see getTifData_S3) or a local raster and gets attributes"""
+    if isinstance(tif, str) and not tif.startswith("s3://"):
+        src = gdal.Open(tif)
+        rb, gt = src.GetRasterBand(1), src.GetGeoTransform()
+        return rb, gt, src, rb.GetNoDataValue()
+    return getTifData_S3(tif)
+
+
+# Memory per cell of a window accumulated by accumulate_window: float32 read,
+# float64 accumulator and wet mask
+WINDOW_BYTES_PER_CELL = 13
+
+# Codecs for the wet/dry and weighted chunk HDFs, see codec_options
+CODECS = ["none", "gzip1", "gzip9", "lzf", "lz4", "zstd", "blosc:lz4", "blosc:zstd"]
+
+
+def codec_options(codec: str) -> dict:
+    """
+    h5py create_dataset keyword arguments for a codec, e.g. "gzip1", "lzf" or
+    "blosc:lz4". LZ4, Zstd and Blosc use the HDF5 filters from hdf5plugin,
+    which must also be installed where the files are read.
+    """
+    if codec in (None, "none"):
+        return {}
+    elif codec.startswith("gzip"):
+        return {"compression": "gzip", "compression_opts": int(codec[4:] or 4)}
+    elif codec == "lzf":
+        return {"compression": "lzf"}
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(f"The {codec} codec requires hdf5plugin")
+    if codec == "lz4":
+        return dict(hdf5plugin.LZ4())
+    elif codec == "zstd":
+        return dict(hdf5plugin.Zstd())
+    elif codec.startswith("blosc:"):
+        return dict(hdf5plugin.Blosc(cname=codec.split(":")[1], clevel=5, shuffle=hdf5plugin.Blosc.NOSHUFFLE))
+    raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+
+
+def register_hdf5_filters():
+    """Registers the hdf5plugin filters, if installed, so that files written with them can be read"""
+    try:
+        import hdf5plugin
+    except ImportError:
+        pass
+
+
+def write_wet_chunk(hf, name: str, chunk_bool, packed: bool = False, codec: str = "gzip9"):
+    """
+    Writes a wet/dry chunk to an open HDF as int8 flags or, if packed, as
+    bits packed along each row (1 bit per cell) with the row width as an attribute.
+    """
+    if packed:
+        ds = hf.create_dataset(name, data=np.packbits(chunk_bool, axis=1), **codec_options(codec))
+        ds.attrs["packed"] = True
+        ds.attrs["width"] = chunk_bool.shape[1]
+    else:
+        hf.create_dataset(name, data=chunk_bool.astype(np.int8), **codec_options(codec))
+
+
+def read_wet_chunk(ds):
+    """Reads a wet/dry chunk written by write_wet_chunk as a bool array"""
+    if ds.attrs.get("packed", False):
+        return np.unpackbits(ds[()], axis=1)[:, :int(ds.attrs["width"])].view(bool)
+    return ds[()].view(bool)
+
+
+def bool_wse_to_hdf(wse_grid: str, model_run_id: str, h5: str, n_row_slices: int = None,
+                    packed: bool = False, codec: str = "gzip9", windows: list = None):
     """
     Reads in raster data as chunks (blocks), row-wise, and outputs
     to a Hierarchical Data Format (HDF).
+    :param packed: Store 1 bit rather than 1 byte per cell, see write_wet_chunk
+    :param codec: Compression of each chunk, see codec_options. gzip9 is very slow to
+        write, gzip1, lzf or the hdf5plugin codecs are much faster for packed chunks.
+    :param windows: Windows to write as chunks, e.g. block aligned windows from
+        get_windows_local, rather than n_row_slices row bands. Each chunk keeps its window
+        as an attribute (row_start, row_stop, col_start, col_stop).
     """
-    rb, gt, src, null_value = getTifData_S3(wse_grid)
-    xsize = rb.XSize
-    ysize = rb.YSize
-    ystep = int(ysize / n_row_slices)  # rows
-    yresidual = ysize - (ystep * n_row_slices)  # last row
-    for i in range(n_row_slices):
-        if i != n_row_slices - 1:
-            chunk = rb.ReadAsArray(0, ystep * i, xsize, ystep)
-            chunk_bool = chunk != null_value
-            with h5py.File(h5, "a") as hf:
-                hf.create_dataset("chunk{}".format(i),
-                                  data=chunk_bool.astype(np.int8),
-                                  compression="gzip",
-                                  compression_opts=9)
-        else:
-            chunk = rb.ReadAsArray(0, ystep * i, xsize, ystep + yresidual)
-            chunk_bool = chunk != null_value
-            with h5py.File(h5, "a") as hf:
-                hf.create_dataset(
-                    "chunk{}".format(i),
-                    data=chunk_bool.astype(np.int8),
-                    compression="gzip",
-                    compression_opts=9,
-                )
-    ds = None
+    with open_raster(wse_grid) as ras, h5py.File(h5, "a") as hf:
+        if windows is None:
+            windows = row_windows(ras.rb.YSize, ras.rb.XSize, n_row_slices)
+        for i, ((ystart, ystop), (xstart, xstop)) in enumerate(windows):
+            chunk = ras.read(((ystart, ystop), (xstart, xstop)))
+            write_wet_chunk(hf, "chunk{}".format(i), chunk != ras.null_value, packed, codec)
+            hf["chunk{}".format(i)].attrs["window"] = (ystart, ystop, xstart, xstop)
     return None
 
 
-def daskbag_bool_wse_hdf_local(wse_grid: str, num_chunks: int, bool_dir: str = "bool_hdfs"):
+def daskbag_bool_wse_hdf_local(wse_grid: str, num_chunks: int = None, bool_dir: str = "bool_hdfs",
+                               packed: bool = False, codec: str = "gzip9", windows: list = None):
     """Dask wrapper for bool_wse_to_hdf function"""
     try:
         if not os.path.exists(bool_dir):
@@ -106,38 +173,775 @@ def daskbag_bool_wse_hdf_local(wse_grid: str, num_chunks: int, bool_dir: str = "
         pass
     model_run_id = os.path.basename(wse_grid).split(".")[0]
     h5 = os.path.join(bool_dir, f"bool_{model_run_id}.hdf")
-    bool_wse_to_hdf(wse_grid, model_run_id, h5, n_row_slices=num_chunks)
+    bool_wse_to_hdf(wse_grid, model_run_id, h5, n_row_slices=num_chunks, packed=packed, codec=codec,
+                    windows=windows)
     return None
 
 
-def write_weighted_chunks_local(c: int,
+def write_weighted_chunks_local(c,
                                 weights_dict: dict,
                                 bool_dir: str = "bool_hdfs",
-                                weighted_dir: str = "weighted_chunks"):
-    """Apply weights to each chunk across many bool hdfs, then write 1 hdf per chunk"""
+                                weighted_dir: str = "weighted_chunks",
+                                codec: str = "gzip9"):
+    """
+    Apply weights to each chunk across many bool hdfs, then write 1 hdf per chunk.
+    Reads int8 or bit-packed chunks, see write_wet_chunk.
+    :param c: Chunk number, or a list of chunk numbers accumulated together so that
+        each bool hdf is opened once for all of them rather than once per chunk
+    """
     try:
         if not os.path.exists(weighted_dir):
             os.mkdir(weighted_dir)
     except FileExistsError:
         pass
+    register_hdf5_filters()
+    chunks = [c] if np.isscalar(c) else list(c)
     filelist = glob(os.path.join(bool_dir, "*.hdf"))
-    for i, f in enumerate(filelist):
+    data, windows = dict.fromkeys(chunks), dict.fromkeys(chunks)
+    for f in filelist:
         run_id = f.split("_")[-2] + '_' + f.split("_")[-1].split(".")[0]
         weight = weights_dict[run_id]
-        if i == 0:
-            with h5py.File(f, "r") as hf:
-                chunk = f"chunk{c}"
-                data = np.array(hf[chunk]) * weight
+        with h5py.File(f, "r") as hf:
+            for chunk in chunks:
+                wet = read_wet_chunk(hf[f"chunk{chunk}"])
+                windows[chunk] = hf[f"chunk{chunk}"].attrs.get("window", windows[chunk])
+                if data[chunk] is None:
+                    data[chunk] = np.zeros(wet.shape, dtype=np.float64)
+                np.add(data[chunk], weight, out=data[chunk], where=wet)
+    for chunk in chunks:
+        weighted_outfile = os.path.join(weighted_dir, f"weighted_{chunk}_.hdf")
+        with h5py.File(weighted_outfile, "a") as hfout:
+            hfout.create_dataset("chunk", data=data[chunk], **codec_options(codec))
+            if windows[chunk] is not None:
+                hfout["chunk"].attrs["window"] = windows[chunk]
+    return
+
+
+def grid_run_id(wse_grid: str) -> str:
+    """Event id of a WSE grid used as the key in the weights dictionary, e.g. H06_E0001"""
+    return "_".join(os.path.basename(wse_grid).split(".")[0].split("_")[-2:])
+
+
+def row_windows(ysize: int, xsize: int, n_row_slices: int) -> list:
+    """
+    Full width row bands ((row_start, row_stop), (col_start, col_stop)) splitting a
+    raster as bool_wse_to_hdf does, with the residual rows in the last band.
+    """
+    ystep = int(ysize / n_row_slices)
+    stops = [ystep * (i + 1) for i in range(n_row_slices - 1)] + [ysize]
+    return [((ystep * i, stop), (0, xsize)) for i, stop in enumerate(stops)]
+
+
+def plan_windows(ysize: int, xsize: int, block_rows: int, block_cols: int, max_memory_gb: float = 1.0,
+                 bytes_per_cell: int = WINDOW_BYTES_PER_CELL) -> list:
+    """
+    Windows ((row_start, row_stop), (col_start, col_stop)) aligned to a raster's
+    internal blocks (tiles or strips), each within max_memory_gb, so that every
+    compressed block is read or written exactly once. Windows span whole rows of
+    blocks while a row of blocks fits in the budget, otherwise runs of blocks
+    along each block row.
+    """
+    max_cells = max(max_memory_gb * 1e9 / bytes_per_cell, block_rows * block_cols)
+    if block_rows * xsize <= max_cells:
+        step = int(max_cells // (block_rows * xsize)) * block_rows
+        return [((r, min(r + step, ysize)), (0, xsize)) for r in range(0, ysize, step)]
+    step = int(max_cells // (block_rows * block_cols)) * block_cols
+    return [((r, min(r + block_rows, ysize)), (c, min(c + step, xsize)))
+            for r in range(0, ysize, block_rows) for c in range(0, xsize, step)]
+
+
+def grid_windows(tif: str, max_memory_gb: float = 1.0, bytes_per_cell: int = WINDOW_BYTES_PER_CELL) -> list:
+    """Block aligned windows of a WSE grid, see plan_windows"""
+    rb, gt, src, null_value = getTifData(tif)
+    block_cols, block_rows = rb.GetBlockSize()
+    return plan_windows(rb.YSize, rb.XSize, block_rows, block_cols, max_memory_gb, bytes_per_cell)
+
+
+def accumulate_window(window: tuple, wse_grids: list, weights_dict: dict) -> tuple:
+    """
+    Weighted wet probability of one window, the sum of weight * (value != nodata)
+    over all WSE grids, read directly from the grids without intermediate files.
+    Returns the window with its float64 accumulator. Each grid is opened by
+    this thread alone (see hecrasio.rasters), so windows can be accumulated in
+    parallel threads.
+    """
+    (ystart, ystop), (xstart, xstop) = window
+    acc = np.zeros((ystop - ystart, xstop - xstart), dtype=np.float64)
+    for wse_grid in wse_grids:
+        weight = weights_dict[grid_run_id(wse_grid)]
+        with open_raster(wse_grid) as ras:
+            chunk = ras.read(window)
+            np.add(acc, weight, out=acc, where=chunk != ras.null_value)
+    return window, acc
+
+
+def write_heatmap_windows(tifTemplate: str, outfile: str, window_arrays, heatmap_dir: str) -> str:
+    """
+    Writes (window, array) pairs, e.g. from accumulate_window, to a float32
+    tif as they arrive so the full heatmap is never held in memory.
+    """
+    if not os.path.exists(heatmap_dir):
+        os.mkdir(heatmap_dir)
+    out_path = os.path.join(heatmap_dir, outfile)
+    with rasterio.open(tifTemplate) as src:
+        profile = src.profile
+    profile.update(dtype=rasterio.float32, count=1, nodata=0, compress="lzw")
+    with rasterio.Env():
+        with rasterio.open(out_path, "w", **profile) as dst:
+            for window, array in window_arrays:
+                dst.write(array.astype(rasterio.float32), 1, window=window)
+    print(f"{out_path} has been written!")
+    return out_path
+
+
+def heatmap_local(wse_grids: list, weights_dict: dict, tifTemplate: str, outfile: str, heatmap_dir: str,
+                  max_memory_gb: float = 1.0, max_workers: int = 4) -> str:
+    """
+    Single pass heatmap: each window is accumulated across all WSE grids in a
+    thread pool and written to the output tif as soon as it completes.
+    :param max_memory_gb: Memory budget of each window, see plan_windows
+    """
+    windows = grid_windows(tifTemplate, max_memory_gb)
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(accumulate_window, w, wse_grids, weights_dict) for w in windows]
+        return write_heatmap_windows(tifTemplate, outfile, (f.result() for f in as_completed(futures)),
+                                     heatmap_dir)
+
+
+def window_zeros(window: tuple):
+    """float64 zeros the shape of a window ((row_start, row_stop), (col_start, col_stop))"""
+    (ystart, ystop), (xstart, xstop) = window
+    return np.zeros((ystop - ystart, xstop - xstart), dtype=np.float64)
+
+
+class Reduction(ABC):
+    """
+    A per cell reduction of WSE grids, accumulated window by window alongside
+    other reductions from the same reads, see accumulate_products.
+    Subclasses set name, nodata, bytes_per_cell (accumulator memory) and
+    band descriptions, and implement start, add and finish. Reductions that
+    can subtract an event by adding it with a negative weight are invertible,
+    others are rebuilt from the remaining events when one is removed, see HeatmapState.
+    """
+
+    name = None
+    nodata = -9999
+    bytes_per_cell = 8
+    invertible = True
+
+    @property
+    def descriptions(self) -> list:
+        """One description per output band"""
+        return [self.name]
+
+    @abstractmethod
+    def start(self, window: tuple):
+        """Returns the accumulator of a window"""
+
+    @abstractmethod
+    def add(self, acc, wse, wet, weight: float):
+        """Adds an event's WSE window, wet mask and weight to the accumulator"""
+
+    @abstractmethod
+    def finish(self, acc):
+        """Returns the output bands of a window, shaped (bands, rows, cols)"""
+
+    def save(self, hf, acc):
+        """Writes the accumulator to an open HDF, see HeatmapState"""
+        hf.create_dataset(self.name, data=acc)
+
+    def load(self, hf, window: tuple):
+        """Reads an accumulator written by save"""
+        return hf[self.name][()]
+
+
+class WetProbability(Reduction):
+    """Sum of the weights of the events wetting each cell, as accumulate_window"""
+
+    name = "wet_probability"
+    nodata = 0
+
+    def start(self, window):
+        return window_zeros(window)
+
+    def add(self, acc, wse, wet, weight):
+        np.add(acc, weight, out=acc, where=wet)
+
+    def finish(self, acc):
+        return acc[np.newaxis]
+
+
+class WeightedMeanWSE(Reduction):
+    """Weighted mean WSE of the events wetting each cell"""
+
+    name = "mean_wse"
+    bytes_per_cell = 16
+
+    def start(self, window):
+        return window_zeros(window), window_zeros(window)
+
+    def add(self, acc, wse, wet, weight):
+        total, weights = acc
+        np.add(total, wse * weight, out=total, where=wet)
+        np.add(weights, weight, out=weights, where=wet)
+
+    def finish(self, acc):
+        total, weights = acc
+        mean = np.full(total.shape, self.nodata, dtype=np.float64)
+        np.divide(total, weights, out=mean, where=weights > 0)
+        return mean[np.newaxis]
+
+    def save(self, hf, acc):
+        hf.create_dataset(self.name, data=np.stack(acc))
+
+    def load(self, hf, window):
+        total, weights = hf[self.name][()]
+        return total, weights
+
+
+class MaxWSE(Reduction):
+    """
+    Maximum WSE of the events wetting each cell. Not invertible, events can be
+    added or reweighted but removing one requires rebuilding the maximum
+    from the remaining events.
+    """
+
+    name = "max_wse"
+    invertible = False
+
+    def start(self, window):
+        (ystart, ystop), (xstart, xstop) = window
+        return np.full((ystop - ystart, xstop - xstart), -np.inf)
+
+    def add(self, acc, wse, wet, weight):
+        np.maximum(acc, wse, out=acc, where=wet)
+
+    def finish(self, acc):
+        return np.where(np.isinf(acc), self.nodata, acc)[np.newaxis]
+
+
+class Exceedance(Reduction):
+    """
+    Sum of the weights of the events exceeding each threshold, one band per threshold.
+    :param thresholds: Depths, or WSEs if no terrain is given, e.g. [0.5, 1, 2, 4]
+    :param terrain: Terrain raster aligned with the WSE grids, exceedance is of
+        depth (WSE - terrain) if given, otherwise of WSE
+    """
+
+    name = "exceedance"
+    nodata = 0
+
+    def __init__(self, thresholds: list, terrain: str = None):
+        self._thresholds = list(thresholds)
+        self._terrain = terrain
+        self.bytes_per_cell = 8 * len(self._thresholds) + (4 if terrain else 0)
+
+    @property
+    def descriptions(self):
+        variable = "depth" if self._terrain else "wse"
+        return [f"{variable} > {t}" for t in self._thresholds]
+
+    def ground(self, window: tuple):
+        """Terrain of a window with nodata as NaN, None without terrain"""
+        if not self._terrain:
+            return None
+        with open_raster(self._terrain) as ras:
+            ground = ras.read(window).astype(np.float64)
+            ground[ground == ras.null_value] = np.nan
+        return ground
+
+    def start(self, window):
+        (ystart, ystop), (xstart, xstop) = window
+        bands = np.zeros((len(self._thresholds), ystop - ystart, xstop - xstart), dtype=np.float64)
+        return bands, self.ground(window)
+
+    def add(self, acc, wse, wet, weight):
+        bands, ground = acc
+        value = wse if ground is None else wse - ground
+        for band, threshold in zip(bands, self._thresholds):
+            np.add(band, weight, out=band, where=wet & (value > threshold))
+
+    def finish(self, acc):
+        return acc[0]
+
+    def save(self, hf, acc):
+        hf.create_dataset(self.name, data=acc[0])
+
+    def load(self, hf, window):
+        return hf[self.name][()], self.ground(window)
+
+
+def default_products() -> list:
+    """Wet probability, weighted mean WSE and max WSE"""
+    return [WetProbability(), WeightedMeanWSE(), MaxWSE()]
+
+
+def accumulate_products(window: tuple, wse_grids: list, weights_dict: dict, products: list) -> tuple:
+    """
+    Accumulates several reductions (see Reduction) of one window from a single
+    read of each WSE grid. Returns the window with a list of float32 arrays,
+    shaped (bands, rows, cols), in the order of products.
+    """
+    accs = [p.start(window) for p in products]
+    for wse_grid in wse_grids:
+        weight = weights_dict[grid_run_id(wse_grid)]
+        with open_raster(wse_grid) as ras:
+            wse = ras.read(window)
+            wet = wse != ras.null_value
+        for p, acc in zip(products, accs):
+            p.add(acc, wse, wet, weight)
+    return window, [p.finish(acc).astype(np.float32) for p, acc in zip(products, accs)]
+
+
+def product_outfiles(outfile: str, products: list, stacked: bool = False) -> list:
+    """Output tif names of products, e.g. heatmap_max_wse.tif, or outfile for all when stacked"""
+    if stacked:
+        return [outfile] * len(products)
+    stem, ext = os.path.splitext(outfile)
+    return [f"{stem}_{p.name}{ext or '.tif'}" for p in products]
+
+
+def write_product_windows(tifTemplate: str, outfile: str, products: list, window_results, heatmap_dir: str,
+                          stacked: bool = False) -> list:
+    """
+    Writes (window, arrays) pairs from accumulate_products as they arrive,
+    to one tif per product or, if stacked, to the bands of a single tif.
+    Bands are described by the product descriptions.
+    """
+    if not os.path.exists(heatmap_dir):
+        os.mkdir(heatmap_dir)
+    with rasterio.open(tifTemplate) as src:
+        profile = src.profile
+    profile.update(dtype=rasterio.float32, compress="lzw")
+    out_paths = [os.path.join(heatmap_dir, f) for f in product_outfiles(outfile, products, stacked)]
+
+    # Each product's first band in its output. Stacked products share one tif and its nodata
+    # value, so each product's own nodata is mapped to Reduction.nodata
+    bands, num_bands = [], 0
+    for p in products:
+        bands.append(num_bands + 1 if stacked else 1)
+        num_bands += len(p.descriptions)
+    with rasterio.Env():
+        dsts = {}
+        try:
+            for p, path, band in zip(products, out_paths, bands):
+                if path not in dsts:
+                    count = num_bands if stacked else len(p.descriptions)
+                    nodata = Reduction.nodata if stacked else p.nodata
+                    dsts[path] = rasterio.open(path, "w", **dict(profile, count=count, nodata=nodata))
+                for i, description in enumerate(p.descriptions):
+                    dsts[path].set_band_description(band + i, description)
+            for window, arrays in window_results:
+                for p, path, band, array in zip(products, out_paths, bands, arrays):
+                    if stacked and p.nodata != Reduction.nodata:
+                        array = np.where(array == p.nodata, Reduction.nodata, array).astype(np.float32)
+                    dsts[path].write(array, list(range(band, band + len(array))), window=window)
+        finally:
+            for dst in dsts.values():
+                dst.close()
+    for path in dict.fromkeys(out_paths):
+        print(f"{path} has been written!")
+    return list(dict.fromkeys(out_paths))
+
+
+def heatmap_products_local(wse_grids: list, weights_dict: dict, tifTemplate: str, outfile: str, heatmap_dir: str,
+                           products: list = None, stacked: bool = False, max_memory_gb: float = 1.0,
+                           max_workers: int = 4) -> list:
+    """
+    Single pass heatmap of several products (default_products if None), e.g.
+    [WetProbability(), MaxWSE(), Exceedance([0.5, 1, 2], terrain="dem.tif")],
+    each computed from the same window reads as heatmap_local and written to its
+    own tif, or its own bands if stacked. Windows are sized to fit all products.
+    """
+    products = products or default_products()
+    bytes_per_cell = 5 + sum(p.bytes_per_cell for p in products)
+    windows = grid_windows(tifTemplate, max_memory_gb, bytes_per_cell)
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(accumulate_products, w, wse_grids, weights_dict, products) for w in windows]
+        return write_product_windows(tifTemplate, outfile, products, (f.result() for f in as_completed(futures)),
+                                     heatmap_dir, stacked)
+
+
+def update_state_window(c: int, state_dir: str, window: tuple, products: list, deltas: list, version: int,
+                        remaining: list = None):
+    """
+    Applies event deltas (wse_grid, weight, count) to the partial sums of window c
+    of a HeatmapState, reading each changed event's window once. New events are
+    added with count 1, removed events with their negative weight and count -1
+    and reweighted events with the weight difference and count 0.
+    The window must be at the previous version, or not yet exist for version 1,
+    so that deltas are never applied twice.
+    :param remaining: (wse_grid, weight) of the events contributing after the update,
+        non-invertible products are rebuilt from these if a removed event wets the window
+    """
+    path = os.path.join(state_dir, f"window_{c}.hdf")
+    if os.path.exists(path):
+        with h5py.File(path, "r") as hf:
+            assert hf.attrs["version"] == version - 1, \
+                f"Window {c} of {state_dir} is at version {hf.attrs['version']}, expected {version - 1}"
+            accs = [p.load(hf, window) for p in products]
+            wet_count = hf["wet_count"][()]
+    else:
+        assert version == 1, f"Window {c} of {state_dir} is missing"
+        accs = [p.start(window) for p in products]
+        (ystart, ystop), (xstart, xstop) = window
+        wet_count = np.zeros((ystop - ystart, xstop - xstart), dtype=np.int32)
+
+    rebuild = False
+    for wse_grid, weight, count in deltas:
+        with open_raster(wse_grid) as ras:
+            wse = ras.read(window)
+            wet = wse != ras.null_value
+        for p, acc in zip(products, accs):
+            if p.invertible or count >= 0:
+                p.add(acc, wse, wet, weight)
+        if count:
+            np.add(wet_count, count, out=wet_count, where=wet)
+        rebuild = rebuild or (count < 0 and wet.any())
+
+    rebuilt = [i for i, p in enumerate(products) if not p.invertible] if rebuild else []
+    if rebuilt:
+        assert remaining is not None, f"Removing events from window {c} requires the remaining events"
+        for i in rebuilt:
+            accs[i] = products[i].start(window)
+        for wse_grid, weight in remaining:
+            with open_raster(wse_grid) as ras:
+                wse = ras.read(window)
+                wet = wse != ras.null_value
+            for i in rebuilt:
+                products[i].add(accs[i], wse, wet, weight)
+
+    # Each window file is replaced atomically, an interrupted update leaves a mix of
+    # versions across windows, which HeatmapState.check reports
+    tmp = f"{path}.part"
+    with h5py.File(tmp, "w") as hf:
+        for p, acc in zip(products, accs):
+            p.save(hf, acc)
+        hf.create_dataset("wet_count", data=wet_count)
+        hf.attrs["version"] = version
+    os.replace(tmp, path)
+    return c
+
+
+class HeatmapState:
+    """
+    Per window partial sums of heatmap products (see Reduction) with a
+    manifest of the contributing events, their grids and weights, so that
+    adding, removing or reweighting events reads only those events' grids.
+    State is kept in state_dir as one HDF per window and manifest.json, and
+    products must be the same (by name) each time the state is opened.
+    Products that are not invertible, e.g. MaxWSE, are rebuilt from the
+    remaining events' grids in the windows a removed event wets.
+    Partial sums are float64, so an updated state matches a rebuild to round-off.
+
+    [usage] state = HeatmapState("heatmap_state", default_products())
+            state.update(wse_grids, weights_dict, tifTemplate)
+            state.write("heatmap.tif", heatmap_dir)
+    """
+
+    def __init__(self, state_dir: str, products: list = None, max_workers: int = 4):
+        self._state_dir = state_dir
+        self._products = products or default_products()
+        self._max_workers = max_workers
+        self._manifest_path = os.path.join(state_dir, "manifest.json")
+        names = [p.name for p in self._products]
+        assert len(set(names)) == len(names), f"Product names must be unique, got {names}"
+
+        self._manifest = {"version": 0, "template": None, "windows": [], "products": names, "events": {}}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self._manifest = json.load(f)
+            assert self._manifest["products"] == names, \
+                f"State {state_dir} has products {self._manifest['products']}, expected {names}"
+
+    @property
+    def state_dir(self):
+        return self._state_dir
+
+    @property
+    def products(self):
+        return self._products
+
+    @property
+    def version(self):
+        """Number of updates applied"""
+        return self._manifest["version"]
+
+    @property
+    def windows(self):
+        return [((r0, r1), (c0, c1)) for r0, r1, c0, c1 in self._manifest["windows"]]
+
+    @property
+    def events(self) -> dict:
+        """Contributing events, {event_id: {"grid": wse_grid, "weight": weight}}"""
+        return dict(self._manifest["events"])
+
+    @property
+    def weights(self) -> dict:
+        return {e: event["weight"] for e, event in self._manifest["events"].items()}
+
+    def check(self):
+        """Asserts every window is at the manifest version, e.g. after an interrupted update"""
+        for c in range(len(self._manifest["windows"])):
+            with h5py.File(os.path.join(self._state_dir, f"window_{c}.hdf"), "r") as hf:
+                assert hf.attrs["version"] == self.version, \
+                    f"Window {c} of {self._state_dir} is not at version {self.version}, rebuild the state"
+
+    def apply(self, deltas: dict, tifTemplate: str = None, max_memory_gb: float = 1.0) -> None:
+        """
+        Applies event deltas, {event_id: (wse_grid, new_weight)} with a new_weight of
+        None to remove the event, then updates the manifest.
+        :param tifTemplate: Grid defining the windows of a new state
+        """
+        events = self._manifest["events"]
+        grid_deltas = []
+        for e, (wse_grid, weight) in deltas.items():
+            if weight is None and e in events:
+                grid_deltas.append((events[e]["grid"], -events[e]["weight"], -1))
+            elif weight is not None and e not in events:
+                grid_deltas.append((wse_grid, weight, 1))
+            elif weight is not None and weight != events[e]["weight"]:
+                grid_deltas.append((events[e]["grid"], weight - events[e]["weight"], 0))
+        if not grid_deltas:
+            print("No changes to apply.")
+            return None
+
+        if self.version == 0:
+            assert tifTemplate, "A tifTemplate is required to create a new state"
+            os.makedirs(self._state_dir, exist_ok=True)
+            # Windows left by an interrupted first build, before the manifest was written
+            for f in glob(os.path.join(self._state_dir, "window_*.hdf*")):
+                os.remove(f)
+            bytes_per_cell = 9 + sum(p.bytes_per_cell for p in self._products)
+            windows = grid_windows(tifTemplate, max_memory_gb, bytes_per_cell)
+            self._manifest["template"] = tifTemplate
+            self._manifest["windows"] = [(r0, r1, c0, c1) for (r0, r1), (c0, c1) in windows]
         else:
-            with h5py.File(f, "r") as hf:
-                chunk = f"chunk{c}"
-                data += np.array(hf[chunk]) * weight
+            self.check()
+
+        updated = {e: dict(event) for e, event in events.items()}
+        for e, (wse_grid, weight) in deltas.items():
+            if weight is None:
+                updated.pop(e, None)
+            elif e in updated:
+                updated[e]["weight"] = weight
+            else:
+                updated[e] = {"grid": wse_grid, "weight": weight}
+        remaining = [(event["grid"], event["weight"]) for event in updated.values()]
+
+        version = self.version + 1
+        print(f"Applying {len(grid_deltas)} event changes to {len(self.windows)} windows.")
+        with ThreadPoolExecutor(self._max_workers) as pool:
+            futures = [pool.submit(update_state_window, c, self._state_dir, w, self._products, grid_deltas, version,
+                                   remaining) for c, w in enumerate(self.windows)]
+            for f in as_completed(futures):
+                f.result()
+
+        self._manifest["events"] = updated
+        self._manifest["version"] = version
+        tmp = f"{self._manifest_path}.part"
+        with open(tmp, "w") as f:
+            json.dump(self._manifest, f, indent=2)
+        os.replace(tmp, self._manifest_path)
+        return None
+
+    def add_events(self, wse_grids: list, weights_dict: dict, tifTemplate: str = None, max_memory_gb: float = 1.0):
+        """Adds the events of WSE grids, creating the state if new (tifTemplate defaults to the first grid)"""
+        self.apply({grid_run_id(g): (g, weights_dict[grid_run_id(g)]) for g in wse_grids},
+                   tifTemplate or wse_grids[0], max_memory_gb)
+
+    def remove_events(self, event_ids: list):
+        """Removes events, e.g. ["H06_E0001"]"""
+        self.apply({e: (None, None) for e in event_ids})
+
+    def reweight(self, weights_dict: dict):
+        """Changes the weights of contributing events, other events in weights_dict are ignored"""
+        self.apply({e: (None, w) for e, w in weights_dict.items() if e in self._manifest["events"]})
+
+    def update(self, wse_grids: list, weights_dict: dict, tifTemplate: str = None, max_memory_gb: float = 1.0):
+        """
+        Brings the state in line with a set of WSE grids and weights, adding new
+        events, removing events no longer in wse_grids and reweighting changed events.
+        """
+        grids = {grid_run_id(g): g for g in wse_grids}
+        deltas = {e: (g, weights_dict[e]) for e, g in grids.items()}
+        deltas.update({e: (None, None) for e in self._manifest["events"] if e not in grids})
+        self.apply(deltas, tifTemplate or wse_grids[0], max_memory_gb)
+
+    def window_results(self):
+        """
+        Yields (window, arrays) as accumulate_products does. Cells never wet are
+        nodata, and sums of removed events that cancel to round-off are zero.
+        """
+        round_off = 1e-9 * max([abs(w) for w in self.weights.values()] or [0])
+        for c, window in enumerate(self.windows):
+            with h5py.File(os.path.join(self._state_dir, f"window_{c}.hdf"), "r") as hf:
+                accs = [p.load(hf, window) for p in self._products]
+                dry = hf["wet_count"][()] == 0
+            arrays = []
+            for p, acc in zip(self._products, accs):
+                array = p.finish(acc)
+                if p.invertible:
+                    array[np.abs(array) < round_off] = 0
+                array = array.astype(np.float32)
+                array[:, dry] = p.nodata
+                arrays.append(array)
+            yield window, arrays
+
+    def write(self, outfile: str, heatmap_dir: str, stacked: bool = False) -> list:
+        """Writes the products to tifs, see write_product_windows"""
+        self.check()
+        return write_product_windows(self._manifest["template"], outfile, self._products, self.window_results(),
+                                     heatmap_dir, stacked)
+
+
+def create_event_cube(cube_path: str, wse_grids: list, windows: list, codec: str = "lzf") -> str:
+    """
+    Creates an event cube, a single HDF holding the wet/dry flags of every WSE grid
+    in a uint8 "wet" dataset of shape (events, rows, cols), with the event ids and
+    windows alongside. Chunks are one event by one window (the first window's
+    shape), so writing or reducing a window touches whole chunks only.
+    :param windows: Windows of the reduction, e.g. from get_windows_local
+    """
+    register_hdf5_filters()
+    rb, gt, src, null_value = getTifData_S3(wse_grids[0])
+    ysize, xsize = rb.YSize, rb.XSize
+    src = None
+    (ystart, ystop), (xstart, xstop) = windows[0]
+    with h5py.File(cube_path, "w") as hf:
+        hf.create_dataset("wet", shape=(len(wse_grids), ysize, xsize), dtype=np.uint8,
+                          chunks=(1, ystop - ystart, xstop - xstart), **codec_options(codec))
+        hf.create_dataset("events", data=np.array([grid_run_id(g) for g in wse_grids], dtype="S"))
+        hf.create_dataset("windows", data=np.array([(r0, r1, c0, c1) for (r0, r1), (c0, c1) in windows]))
+        hf.create_dataset("written", shape=(len(wse_grids),), dtype=np.uint8)
+    return cube_path
+
+
+def cube_events(hf) -> list:
+    """Event ids of an open event cube, in the order of its first axis"""
+    return [e.decode() for e in hf["events"][()]]
+
+
+def read_event_windows(wse_grid: str, windows) -> list:
+    """
+    Wet/dry flags of each window (row_start, row_stop, col_start, col_stop) of a
+    WSE grid, bit packed along rows to keep the copy passed to the writer small.
+    """
+    with open_raster(wse_grid) as ras:
+        return [np.packbits(ras.read(((ystart, ystop), (xstart, xstop))) != ras.null_value, axis=1)
+                for ystart, ystop, xstart, xstop in windows]
+
+
+def write_event_windows(hf, e: int, windows, packed_windows: list, lock: FileLock = None):
+    """
+    Writes the windows from read_event_windows to event e of an open event cube,
+    then marks the event as written. A held lock is refreshed after each window.
+    """
+    for (ystart, ystop, xstart, xstop), packed in zip(windows, packed_windows):
+        hf["wet"][e, ystart:ystop, xstart:xstop] = np.unpackbits(packed, axis=1)[:, :xstop - xstart]
+        if lock is not None:
+            lock.refresh()
+    hf["written"][e] = 1
+
+
+def write_event_to_cube(wse_grid: str, cube_path: str, lock_path: str = None):
+    """
+    Writes the wet/dry flags of a WSE grid to its slice of an event cube (see
+    create_event_cube) from any process. HDF5 does not support concurrent
+    writers, so the grid is read first, then all of its windows are written in
+    one open of the cube under a FileLock. Where one process can own the cube,
+    write_events_to_cube avoids the lock.
+    """
+    register_hdf5_filters()
+    lock_path = lock_path or f"{cube_path}.lock"
+    with FileLock(lock_path, timeout=float("inf")):
+        with h5py.File(cube_path, "r") as hf:
+            e = cube_events(hf).index(grid_run_id(wse_grid))
+            windows = hf["windows"][()]
+    packed_windows = read_event_windows(wse_grid, windows)
+    with FileLock(lock_path, timeout=float("inf")) as lock:
+        with h5py.File(cube_path, "a") as hf:
+            write_event_windows(hf, e, windows, packed_windows, lock)
+    return None
+
+
+def write_events_to_cube(wse_grids: list, cube_path: str, max_workers: int = 4):
+    """
+    Single writer for an event cube: WSE grids are read in a thread pool, at
+    most 2 * max_workers at a time, and written by this thread as they complete
+    through one open of the cube.
+    """
+    register_hdf5_filters()
+    with h5py.File(cube_path, "a") as hf, ThreadPoolExecutor(max_workers) as pool:
+        events = cube_events(hf)
+        windows = hf["windows"][()]
+        todo = iter(wse_grids)
+        futures = {pool.submit(read_event_windows, g, windows): g for g in islice(todo, 2 * max_workers)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                wse_grid = futures.pop(future)
+                write_event_windows(hf, events.index(grid_run_id(wse_grid)), windows, future.result())
+                for g in islice(todo, 1):
+                    futures[pool.submit(read_event_windows, g, windows)] = g
+    return None
+
+
+def reduce_cube_window(c: int, cube_path: str, weights_dict: dict, weighted_dir: str = "weighted_chunks",
+                       codec: str = "gzip9", max_memory_gb: float = 1.0):
+    """
+    Apply weights to window c across all events of an event cube, then write 1 hdf
+    per window as write_weighted_chunks_local does. Events are read as contiguous
+    hyperslabs of as many events as fit in max_memory_gb. Events not yet written
+    to the cube are skipped with a warning.
+    """
+    try:
+        if not os.path.exists(weighted_dir):
+            os.mkdir(weighted_dir)
+    except FileExistsError:
+        pass
+    register_hdf5_filters()
+    with h5py.File(cube_path, "r") as hf:
+        events = cube_events(hf)
+        written = hf["written"][()]
+        ystart, ystop, xstart, xstop = [int(w) for w in hf["windows"][c]]
+        missing = [e for e, w in zip(events, written) if not w]
+        if missing:
+            print(f"WARNING! {len(missing)} events were not written to {cube_path} and are skipped: {missing[:10]}")
+        weights = [weights_dict[e] if w else 0 for e, w in zip(events, written)]
+
+        data = np.zeros((ystop - ystart, xstop - xstart), dtype=np.float64)
+        step = max(1, int(max_memory_gb * 1e9 / data.size))
+        for e0 in range(0, len(events), step):
+            wet = hf["wet"][e0:e0 + step, ystart:ystop, xstart:xstop]
+            for weight, event_wet in zip(weights[e0:e0 + step], wet):
+                if weight:
+                    np.add(data, weight, out=data, where=event_wet.view(bool))
     weighted_outfile = os.path.join(weighted_dir, f"weighted_{c}_.hdf")
-    with h5py.File(weighted_outfile, "a") as hfout:
-        hfout.create_dataset("chunk", data=data, compression="gzip", compression_opts=9)
+    with h5py.File(weighted_outfile, "w") as hfout:
+        hfout.create_dataset("chunk", data=data, **codec_options(codec))
+        hfout["chunk"].attrs["window"] = (ystart, ystop, xstart, xstop)
     return
 
 
+def heatmap_cube_local(wse_grids: list, weights_dict: dict, tifTemplate: str, outfile: str, heatmap_dir: str,
+                       cube_path: str = "events.hdf", weighted_dir: str = "weighted_chunks",
+                       max_memory_gb: float = 1.0, max_workers: int = 4, codec: str = "lzf") -> str:
+    """
+    Two stage heatmap through an event cube: the WSE grids are written to the cube
+    (see write_events_to_cube), then each window is reduced and written to the output tif.
+    """
+    windows = grid_windows(tifTemplate, max_memory_gb)
+    create_event_cube(cube_path, wse_grids, windows, codec)
+    write_events_to_cube(wse_grids, cube_path, max_workers)
+    with ThreadPoolExecutor(max_workers) as pool:
+        list(pool.map(lambda c: reduce_cube_window(c, cube_path, weights_dict, weighted_dir, codec, max_memory_gb),
+                      range(len(windows))))
+    chunk_hdfs = [os.path.join(weighted_dir, f"weighted_{c}_.hdf") for c in range(len(windows))]
+    writeTifByChunks_local(tifTemplate, outfile, chunk_hdfs, heatmap_dir)
+    return os.path.join(heatmap_dir, outfile)
+
+
 def update_tif_metadata(outputTif, meta_dict):
     """Update the metadata of a tif using a dictionary"""
     ds = gdal.Open(outputTif, gdal.GA_Update)
@@ -185,10 +989,27 @@ def get_num_chunks_local(tif):
     return num_chunks, num_workers
 
 
+def get_windows_local(tif, max_memory_gb: float = 2.0):
+    """
+    Plans block aligned windows of the raster within max_memory_gb each (see
+    plan_windows) and returns them with the number of workers that should be used.
+    """
+    windows = grid_windows(tif, max_memory_gb)
+    print(f"Using {len(windows)} windows of up to {max_memory_gb} GB.")
+    my_mem = psutil.virtual_memory().total / 1e9
+    (ystart, ystop), (xstart, xstop) = windows[0]
+    window_mem = (ystop - ystart) * (xstop - xstart) * WINDOW_BYTES_PER_CELL / 1e9
+    num_workers = max(1, min(int(my_mem / window_mem), int(2.5 * cpu_count()), len(windows)))
+    print(f"Using {num_workers} for the number of workers.")
+    return windows, num_workers
+
+
 def writeTifByChunks_local(tifTemplate: str, outfile: str, chunk_hdfs: list, heatmap_dir: str):
     """
     Given a sorted list of local HDF files representing chunks of a tif,
     write the final output tif in chunks (for memory management).
+    Chunks with a window attribute (see bool_wse_to_hdf) are written to
+    their window, so their order does not matter.
     """
     if not os.path.exists(heatmap_dir):
         os.mkdir(heatmap_dir)
@@ -200,14 +1021,18 @@ def writeTifByChunks_local(tifTemplate: str, outfile: str, chunk_hdfs: list, hea
             for i, f in enumerate(chunk_hdfs):
                 with h5py.File(f, "r") as hf:
                     chunkArray = np.array(hf["chunk"])
-                if i == 0:
+                    window = hf["chunk"].attrs.get("window")
+                if window is not None:
+                    ystart, ystop, xstart, xstop = [int(w) for w in window]
+                    dst.write(chunkArray.astype(rasterio.float32), 1, window=((ystart, ystop), (xstart, xstop)))
+                elif i == 0:
                     ystart = 0
                     ystop = chunkArray.shape[0]
                     dst.write(chunkArray.astype(rasterio.float32),
                               1,
                               window=((ystart, ystop), (0, chunkArray.shape[1])))
                 else:
-                    ystart += chunkArray.shape[0]
+                    ystart = ystop
                     ystop += chunkArray.shape[0]
                     dst.write(chunkArray.astype(rasterio.float32),
                               1,
@@ -269,7 +1094,7 @@ def clip_off_nodatas(in_filename, out_filename):
     ur = raster.transform * (xmax, ymax)
     lr = raster.transform * (xmax, ymin)
     ll = raster.transform * (xmin, ymin)
-    clip_poly = Polygon([ul, ur, lr, ll])
+    clip_poly = shapely_geometry.Polygon([ul, ur, lr, ll])
     raster.close()
     clip_rast([clip_poly], in_filename, out_filename)
     return
@@ -0,0 +1,75 @@
+"""
+PFRA Module for deferring heavy imports and S3 clients to first use
+
+Importing geopandas, rasterio, gdal, matplotlib or boto3 takes seconds,
+which every short lived PostProcessor or dask worker would otherwise pay
+whether it uses them or not.
+"""
+
+import importlib
+import threading
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access,
+    e.g. gpd = LazyModule('geopandas').
+    :param name: Module name
+    :param submodules: Submodules imported along with the module, e.g. 'rasterio.mask'
+    :param on_import: Called with the module once imported, e.g. to configure it
+    """
+
+    def __init__(self, name: str, *submodules, on_import=None):
+        self.__dict__.update(_name=name, _submodules=submodules, _on_import=on_import, _module=None)
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            if self._on_import is not None:
+                self._on_import(module)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module {} ({})>'.format(self._name, state)
+
+
+def get_s3():
+    """Returns the shared boto3 S3 resource, created on first use"""
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                import boto3
+                _s3 = boto3.resource('s3')
+    return _s3
+
+
+class LazyS3:
+    """
+    Stand-in for the shared boto3 S3 resource, created by get_s3 on first
+    attribute access, e.g. s3 = LazyS3(); s3.Object(bucket, key)
+    """
+
+    def __getattr__(self, attr):
+        return getattr(get_s3(), attr)
+
+    def __repr__(self):
+        state = 'created' if _s3 is not None else 'not created'
+        return '<lazy s3 resource ({})>'.format(state)
@@ -1,26 +1,34 @@
 """
 PFRA Module for working with HEC-RAS model output files
 """
-import gdal
 from time import time
-import geopandas as gpd
-from geopandas.tools import sjoin
-from shapely.ops import cascaded_union
-from shapely.geometry import Point, LineString, Polygon
 import numpy as np
 import pandas as pd
 import h5py
-from matplotlib import pyplot as plt
 from hecrasio.core import ResultsZip
+from hecrasio.streams import open_hdf
 from io import BytesIO
-import boto3
-import rasterio
-from rasterio.plot import show
 import pathlib as pl
 import os
 import shutil
 from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import json
+from hecrasio.lazy import LazyModule
+
+# Geometry and grouping dependencies, imported on first use
+gpd = LazyModule('geopandas')
+shapely_geometry = LazyModule('shapely.geometry')
+shapely_ops = LazyModule('shapely.ops')
+spatial = LazyModule('scipy.spatial')
+sparse = LazyModule('scipy.sparse', 'scipy.sparse.csgraph')
+
+# Only needed for plots and raster output, imported on first use
+plt = LazyModule('matplotlib.pyplot')
+gdal = LazyModule('gdal', on_import=lambda gdal: gdal.UseExceptions())
+rasterio = LazyModule('rasterio')
+boto3 = LazyModule('boto3')
 
 # Add additional keys as needed
 GEOMETRY_ATTRIBUTES = '/Geometry/2D Flow Areas/Attributes'
@@ -32,6 +40,9 @@ EVENT_DATA_BC = '/Event Conditions/Unsteady/Boundary Conditions'
 UNSTEADY_SUMMARY = '/Results/Unsteady/Summary'
 TSERIES_RESULTS_2DFLOW_AREA = '/Results/Unsteady/Output/Output Blocks/Base Output/Unsteady Time Series/2D Flow Areas'
 
+# DomainResults attributes read directly from results tables: (table, absolute values)
+TSERIES_TABLES = {'Face_Velocity': ('Face Velocity', True), 'Depth': ('Depth', False)}
+
 
 class PFRAError:
     """
@@ -46,9 +57,11 @@ class HDFResultsFile:
     """
     HEC-RAS HDF Plan File Object to compute flow data at breaklines.
     Some functionality may be useful for other ras objects.
+    Set stream to true to read the plan in place from the model rather than
+    extracting it to the working directory.
     """
 
-    def __init__(self, model:ResultsZip, model_path:str, path:str):
+    def __init__(self, model:ResultsZip, model_path:str, path:str, stream:bool=False):
 
         self.__model = model
         if '.zip' in model_path:
@@ -71,8 +84,13 @@ class HDFResultsFile:
             Add Description
             :return:
             """
+            if stream:
+                try:
+                    return open_hdf(self.__model.open(path))
+                except ValueError as e:
+                    print('{}, extracting instead'.format(e))
             try:
-                self.__model.zipfile.extract(self.__zip_path)
+                self.__model.extract(self.__zip_path)
                 return h5py.File(self.__zip_path, 'r')
             except:
                 return h5py.File(self.__path, 'r')
@@ -111,7 +129,7 @@ class HDFResultsFile:
         def get_perimeter(domain):
             """Creates a perimeter polygon from points"""
             d_array = get_geometry_data('Perimeter', domain)
-            aoi = Polygon([tuple(p) for p in d_array])
+            aoi = shapely_geometry.Polygon([tuple(p) for p in d_array])
             return gpd.GeoDataFrame(geometry=gpd.GeoSeries(aoi))
         
         def get_domain_geometries():
@@ -183,18 +201,80 @@ class HDFResultsFile:
         return self._2dFlowArea
 
 
+class BoundsIndex:
+    """
+    Uniform grid spatial index over bounding boxes (points have zero size).
+    Items are binned by the grid cell holding their lower left corner and
+    sorted by cell, so a query only visits the cells overlapping the query
+    box and its cost scales with the number of items returned.
+    """
+
+    def __init__(self, minx: np.ndarray, miny: np.ndarray, maxx: np.ndarray, maxy: np.ndarray,
+                 cell_size: float = None):
+        self._bounds = np.column_stack([minx, miny, maxx, maxy]).astype(np.float64).reshape(-1, 4)
+        minx, miny, maxx, maxy = self._bounds.T
+        n = len(minx)
+        self._extent = max((maxx - minx).max(), (maxy - miny).max()) if n else 0.0
+        self._x0, self._y0 = (minx.min(), miny.min()) if n else (0.0, 0.0)
+
+        if cell_size is None:
+            area = (maxx.max() - self._x0) * (maxy.max() - self._y0) if n else 0.0
+            cell_size = max(self._extent, np.sqrt(area / n) if n else 0.0)
+        self._cell_size = cell_size if cell_size > 0 else 1.0
+
+        cols = ((minx - self._x0) // self._cell_size).astype(np.int64)
+        rows = ((miny - self._y0) // self._cell_size).astype(np.int64)
+        self._ncols = int(cols.max()) + 1 if n else 1
+        self._nrows = int(rows.max()) + 1 if n else 1
+        keys = rows * self._ncols + cols
+        self._order = np.argsort(keys, kind='stable')
+        self._keys = keys[self._order]
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def candidates(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Positional indices of items whose grid cells overlap the box"""
+        c0 = max(int((x0 - self._extent - self._x0) // self._cell_size), 0)
+        r0 = max(int((y0 - self._extent - self._y0) // self._cell_size), 0)
+        c1 = min(int((x1 - self._x0) // self._cell_size), self._ncols - 1)
+        r1 = min(int((y1 - self._y0) // self._cell_size), self._nrows - 1)
+        if c1 < c0 or r1 < r0:
+            return np.array([], dtype=np.int64)
+        rows = np.arange(r0, r1 + 1) * self._ncols
+        lo = np.searchsorted(self._keys, rows + c0, side='left')
+        hi = np.searchsorted(self._keys, rows + c1, side='right')
+        return np.concatenate([self._order[l:h] for l, h in zip(lo, hi)])
+
+    def within(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Sorted positional indices of items lying within the box"""
+        idx = self.candidates(x0, y0, x1, y1)
+        b = self._bounds[idx]
+        keep = (b[:, 0] >= x0) & (b[:, 1] >= y0) & (b[:, 2] <= x1) & (b[:, 3] <= y1)
+        return np.sort(idx[keep])
+
+    def intersects(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Sorted positional indices of items whose bounding boxes intersect the box"""
+        idx = self.candidates(x0, y0, x1, y1)
+        b = self._bounds[idx]
+        keep = (b[:, 0] <= x1) & (b[:, 1] <= y1) & (b[:, 2] >= x0) & (b[:, 3] >= y0)
+        return np.sort(idx[keep])
+
+
 class DomainResults:
     """
     HEC-RAS HDF Plan File Object to compute flow data at breaklines.
     Some functionality may be useful for other ras objects.
     """
 
-    def __init__(self, model: ResultsZip, plan: HDFResultsFile, domain: str):
+    def __init__(self, model: ResultsZip, plan: HDFResultsFile, domain: str, lazy: bool = False):
         # Specify Domain to instantiate Object
         self.__model = model
         self._plan = plan
         self._domain = domain
         self._plan_data = self._plan.hdfLocal
+        self._lazy = lazy
+        self._scans = {}
 
         def get_domain_cell_size():
             """Identifies mean cell size for a domain"""
@@ -221,6 +301,15 @@ class DomainResults:
                 table_data[g] = np.array(self._plan_data['{}/{}/{}'.format(EVENT_DATA_BC, table, g)])
             return table_data
 
+        def get_boundary_condition(table, verbose=True):
+            """Returns forcing data for a boundary condition table, None if missing"""
+            try:
+                return get_tseries_forcing(table)
+            except KeyError as e:
+                if verbose:
+                    print(e)
+                return None
+
         def get_geometry_data(table):
             """Read in data from results tables"""
             data = '{}/{}/{}'.format(GEOMETRY_2DFLOW_AREA, self._domain, table)
@@ -229,201 +318,268 @@ class DomainResults:
         def get_perimeter():
             """Creates a perimeter polygon from points"""
             d_array = get_geometry_data('Perimeter')
-            aoi = Polygon([tuple(p) for p in d_array])
+            aoi = shapely_geometry.Polygon([tuple(p) for p in d_array])
             return gpd.GeoDataFrame(geometry=gpd.GeoSeries(aoi))
 
-        def get_face():
-            """Returns GeoDataFrame with Faces per pair of Face Indices"""
-            gdf = gpd.GeoDataFrame(self._Faces_FacePoint_Indexes, columns=['from_idx', 'to_idx'])
-            gdf['face'] = gdf.apply(lambda row:
-                                    LineString([self._Face_FacePoints_Coordinate[row['from_idx']],
-                                                self._Face_FacePoints_Coordinate[row['to_idx']]]),
-                                    axis=1)
-            gdf['geometry'] = gdf['face']
-            gdf = gdf.drop(['from_idx', 'to_idx', 'face'], axis=1)
-            return gdf
-
-        def get_centroids():
-            """Returns GeoDataFrame with Face centroids per pair of Face Indices"""
-            gdf = get_face()
-            gdf['face_cnt'] = gdf.apply(lambda row: row.geometry.centroid, axis=1)
-            gdf['geometry'] = gdf['face_cnt']
-            gdf = gdf.drop(['face_cnt'], axis=1)
-            return gdf
-
         def describe_depth():
             """Calculate max, min, and range of depths for each cell center"""
             # Pull in cell centroids and attribute them
-            cc_array = self._Cells_Center_Coordinate
-            cc_gdf = gpd.GeoDataFrame([Point([coord[0], coord[1]]) for coord in cc_array], columns=['geometry'])
-            depth_array = self._Depth
-
-            # Attribute cell centroids with depths
-            # NOT USED?
-            # cc_attr = pd.concat([cc_gdf, depth_array], axis=1)
+            cc_array = self.Cells_Center_Coordinate
+            cc_gdf = gpd.GeoDataFrame([shapely_geometry.Point([coord[0], coord[1]]) for coord in cc_array],
+                                      columns=['geometry'])
+            depth_stats = self.Depth_Stats
 
             # Obtain descriptive statistics for each centroid
-            max_attr = pd.DataFrame(depth_array.max(axis=1), columns=['max'])
+            max_attr = depth_stats[['max']]
             max_gdf = pd.concat([cc_gdf, max_attr], axis=1)
             max_gdf_nonzero = max_gdf[max_gdf['max'] != 0]
 
-            min_attr = pd.DataFrame(depth_array.min(axis=1), columns=['min'])
+            min_attr = depth_stats[['min']]
             min_gdf = pd.concat([cc_gdf, min_attr], axis=1)
             min_gdf_nonzero = min_gdf[min_gdf['min'] != 0]
             return max_gdf_nonzero, min_gdf_nonzero
 
         def get_avg_depth():
             """Calculates average depth at faces returning an array."""
+            depth = self.Depth
             depth_list = []
-            for (c1_idx, c2_idx) in self._Faces_Cell_Indexes:
-                # cat_depths = np.stack([self._Depth.loc[c1_idx], self._Depth.loc[c2_idx]])
-                cat_depths = np.stack([self._Depth[c1_idx, :], self._Depth[c2_idx, :]])
+            for (c1_idx, c2_idx) in self.Faces_Cell_Indexes:
+                cat_depths = np.stack([depth[c1_idx, :], depth[c2_idx, :]])
                 avg_face = np.average(cat_depths, axis=0)
                 depth_list.append(np.around(avg_face, decimals=2))
                 # np.stack use default axis=0
             return pd.DataFrame(np.stack(depth_list))
 
-        def get_extreme_edge_depths():
-            """Identifies Face Centroids with absolute, avgerage depths greater-than one foot"""
-            # Obtain boundary line
-            boundary_line = list(self._Perimeter['geometry'])[0].boundary
-            # Identify external faces
-            df = pd.DataFrame()
-            df['exterior'] = self._Faces.geometry.apply(lambda lstring: lstring.intersects(boundary_line))
-
-            # Identify minima
-            attr = pd.DataFrame(abs(self._Avg_Face_Depth).max(axis=1), columns=['abs_max'])
-            face_dp = pd.concat([self._Face_Centroid_Coordinates, attr], axis=1)
-            exterior_faces = face_dp[df['exterior'] == True]
-            return exterior_faces[exterior_faces['abs_max'] > 1]
+        def get_domain_cell_count():
+            """Number of real cells in the domain, excluding the external cells along the perimeter"""
+            attributes = self._plan_data[GEOMETRY_ATTRIBUTES][()]
+            domain_row = [row for row in attributes if row[0].decode() == self._domain][0]
+            return int(domain_row['Cell Count'])
+
+        def get_boundary_faces():
+            """Identifies perimeter faces from mesh topology, i.e. faces bounding only one real cell"""
+            cells = self.Faces_Cell_Indexes
+            real = (cells >= 0) & (cells < get_domain_cell_count())
+            return np.flatnonzero(real.sum(axis=1) == 1)
 
         def get_extreme_edge_depths():
             """Identifies Face Centroids with absolute, avgerage depths greater-than one foot"""
-            # Obtain boundary line
-            boundary_line = list(self._Perimeter['geometry'])[0].boundary
-
-            # Identify external faces
-            df = pd.DataFrame()
-            perimeter = gpd.GeoDataFrame(gpd.GeoSeries(boundary_line).to_frame(), geometry=0)
-            intersections = gpd.sjoin(perimeter, self._Faces, how="inner", op='intersects')
-
-            # Identify minima
-            attr = pd.DataFrame(abs(self._Avg_Face_Depth).max(axis=1), columns=['abs_max'])
-            face_dp = pd.concat([self._Face_Centroid_Coordinates, attr], axis=1)
-            exterior_faces = face_dp.loc[intersections['index_right']]
-            return exterior_faces[exterior_faces['abs_max'] > 1]
+            exterior = self.Boundary_Faces
 
-        try:
-            self._StageBC = get_tseries_forcing('Stage Hydrographs')
-        except KeyError as e:
-            self._StageBC = None
+            # Identify maxima of the absolute average depth at exterior faces only
+            if '_Avg_Face_Depth' in self.__dict__:
+                abs_max = abs(self.Avg_Face_Depth).values[exterior].max(axis=1)
+            else:
+                c1_idx, c2_idx = self.Faces_Cell_Indexes[exterior].T
+                abs_max = np.full(len(exterior), -np.inf)
+                data = '{}/{}/{}'.format(TSERIES_RESULTS_2DFLOW_AREA, self._domain, 'Depth')
+                for _, block in tseries_blocks(self._plan_data[data]):
+                    avg_face = np.around((block[:, c1_idx] + block[:, c2_idx]) / 2, decimals=2)
+                    np.maximum(abs_max, np.abs(avg_face).max(axis=0), out=abs_max)
+
+            attr = pd.DataFrame({'abs_max': abs_max}, index=exterior)
+            attr = attr[attr['abs_max'] > 1]
+            return pd.concat([face_centroids(self.Face_Geometry, attr.index), attr], axis=1)
+
+        # Attribute loaders, in the order they are computed when not lazy
+        self._loaders = {
+            'StageBC': lambda: get_boundary_condition('Stage Hydrographs', verbose=False),
+            'FlowBC': lambda: get_boundary_condition('Flow Hydrographs'),
+            'PrecipBC': lambda: get_boundary_condition('Precipitation Hydrographs'),
+            'CellSize': get_domain_cell_size,
+            'Faces_FacePoint_Indexes': lambda: get_geometry_data('Faces FacePoint Indexes'),
+            'Face_FacePoints_Coordinate': lambda: get_geometry_data('FacePoints Coordinate'),
+            'Faces_Cell_Indexes': lambda: get_geometry_data('Faces Cell Indexes'),
+            'Face_Velocity': lambda: abs(get_tseries_results('Face Velocity')),
+            'Face_Geometry': lambda: face_geometry(self.Faces_FacePoint_Indexes,
+                                                   self.Face_FacePoints_Coordinate),
+            'Face_Centroid_Coordinates': lambda: face_centroids(self.Face_Geometry),
+            'Cells_Center_Coordinate': lambda: get_geometry_data('Cells Center Coordinate'),
+            'Depth': lambda: np.array(get_tseries_results('Depth')),
+            'Depth_Stats': lambda: self.reduce_tseries_results('Depth'),
+            'Describe_Depths': describe_depth,
+            'Avg_Face_Depth': get_avg_depth,
+            'Perimeter': get_perimeter,
+            'Faces': lambda: face_lines(self.Face_Geometry),
+            'Face_Index': lambda: BoundsIndex(*self.Face_Geometry[['minx', 'miny', 'maxx', 'maxy']].values.T),
+            'Boundary_Faces': get_boundary_faces,
+            'Extreme_Edges': get_extreme_edge_depths,
+        }
+
+        if not self._lazy:
+            for name in self._loaders:
+                self._get_attribute(name)
+
+    def _get_attribute(self, name: str):
+        """Returns a cached attribute, computing it on first access"""
+        key = '_{}'.format(name)
+        if key not in self.__dict__:
+            self.__dict__[key] = self._loaders[name]()
+        return self.__dict__[key]
+
+    def release(self, *names: str) -> None:
+        """
+        Drops cached attributes so that memory is freed, they are recomputed on next access
+        :param names: Attribute names, e.g. 'Depth', 'Avg_Face_Depth'. All are released if none are given.
+        """
+        names = names if names else tuple(self._loaders)
+        for name in names:
+            assert name in self._loaders, 'Unknown attribute {}, expected one of {}'.format(name, list(self._loaders))
+            self.__dict__.pop('_{}'.format(name), None)
+        self._scans = {key: scan for key, scan in self._scans.items() if key[0] not in names}
 
-        try:
-            self._FlowBC = get_tseries_forcing('Flow Hydrographs')
-        except KeyError as e:
-            print(e)
-            self._FlowBC = None
+    @property
+    def domain(self):
+        """Domain name"""
+        return self._domain
 
-        try:
-            self._PrecipBC = get_tseries_forcing('Precipitation Hydrographs')
-        except KeyError as e:
-            print(e)
-            self._PrecipBC = None
-
-        self._CellSize = get_domain_cell_size()
-        self._Faces_FacePoint_Indexes = get_geometry_data('Faces FacePoint Indexes')
-        self._Face_FacePoints_Coordinate = get_geometry_data('FacePoints Coordinate')
-        self._Faces_Cell_Indexes = get_geometry_data('Faces Cell Indexes')
-        self._Face_Velocity = abs(get_tseries_results('Face Velocity'))
-        self._Face_Centroid_Coordinates = get_centroids()
-        self._Cells_Center_Coordinate = get_geometry_data('Cells Center Coordinate')
-        self._Depth = np.array(get_tseries_results('Depth'))
-        self._Describe_Depths = describe_depth()
-        self._Avg_Face_Depth = get_avg_depth()
-        self._Perimeter = get_perimeter()
-        self._Faces = get_face()
-        self._Extreme_Edges = get_extreme_edge_depths()
+    @property
+    def lazy(self):
+        """Attributes are computed on first access when True"""
+        return self._lazy
 
     @property
     def CellSize(self):
         """Domain mean cell size"""
-        print('Domain ID: {}, Average Cell Size = {}'.format(self._domain, self._CellSize))
-        return self._CellSize
+        cell_size = self._get_attribute('CellSize')
+        print('Domain ID: {}, Average Cell Size = {}'.format(self._domain, cell_size))
+        return cell_size
 
     @property
     def StageBC(self):
         """Stage boundary conditions"""
-        return self._StageBC
+        return self._get_attribute('StageBC')
 
     @property
     def FlowBC(self):
         """Flow boundary conditions"""
-        return self._FlowBC
+        return self._get_attribute('FlowBC')
 
     @property
     def PrecipBC(self):
         """Precipitation boundary conditions"""
-        return self._PrecipBC
+        return self._get_attribute('PrecipBC')
 
     @property
     def Faces_FacePoint_Indexes(self):
         """Indices of face points used to create each Face"""
-        return self._Faces_FacePoint_Indexes
+        return self._get_attribute('Faces_FacePoint_Indexes')
 
     @property
     def Face_FacePoints_Coordinate(self):
         """Coordinates of face points"""
-        return self._Face_FacePoints_Coordinate
+        return self._get_attribute('Face_FacePoints_Coordinate')
 
     @property
     def Cells_Center_Coordinate(self):
         """Coordinates of cell centers"""
-        return self._Cells_Center_Coordinate
+        return self._get_attribute('Cells_Center_Coordinate')
 
     @property
     def Faces(self):
         """Faces created from face point indecies and coordinates"""
-        return self._Faces
+        return self._get_attribute('Faces')
+
+    @property
+    def Face_Geometry(self):
+        """Face endpoints, centroids, lengths and bounding boxes as arrays"""
+        return self._get_attribute('Face_Geometry')
+
+    @property
+    def Face_Index(self):
+        """Spatial index over face bounding boxes"""
+        return self._get_attribute('Face_Index')
 
     @property
     def Face_Centroid_Coordinates(self):
         """Centroid of faces"""
-        return self._Face_Centroid_Coordinates
+        return self._get_attribute('Face_Centroid_Coordinates')
 
     @property
     def Faces_Cell_Indexes(self):
         """Indecies of cells bounded by each face"""
-        return self._Faces_Cell_Indexes
+        return self._get_attribute('Faces_Cell_Indexes')
 
     @property
     def Face_Velocity(self):
         """Velocity measurements at each face"""
-        return self._Face_Velocity
+        return self._get_attribute('Face_Velocity')
 
     @property
     def Depth(self):
         """Depth measurements at each cell center"""
-        return self._Depth
+        return self._get_attribute('Depth')
+
+    @property
+    def Depth_Stats(self):
+        """Max, min and time step of max depth for each cell center, streamed from the HDF"""
+        return self._get_attribute('Depth_Stats')
 
     @property
     def Describe_Depths(self):
         """Max, min, and range of depths for each cell center"""
-        return self._Describe_Depths
+        return self._get_attribute('Describe_Depths')
 
     @property
     def Avg_Face_Depth(self):
         """Average depth of cell centers bounding a face"""
-        return self._Avg_Face_Depth
+        return self._get_attribute('Avg_Face_Depth')
 
     @property
     def Perimeter(self):
         """Domain area polygon"""
-        return self._Perimeter
+        return self._get_attribute('Perimeter')
+
+    @property
+    def Boundary_Faces(self):
+        """Indices of faces along the domain perimeter"""
+        return self._get_attribute('Boundary_Faces')
 
     @property
     def Extreme_Edges(self):
         """Perimeter face centroids with absolute, average depths greater than one"""
-        return self._Extreme_Edges
+        return self._get_attribute('Extreme_Edges')
+
+    def reduce_tseries_results(self, table: str, thresholds: list = None, absolute: bool = False,
+                               max_memory_gb: float = 0.5) -> pd.DataFrame:
+        """
+        Streams a results table from the HDF in time blocks returning statistics
+            per cell or face without loading the full table into memory.
+        :param table: Results table, e.g. 'Depth' or 'Face Velocity'
+        :param thresholds: Counts time steps above each value, with the first and last, see reduce_tseries
+        :param absolute: Reduce absolute values
+        :param max_memory_gb: Memory budget for each time block
+        :return:
+        """
+        data = '{}/{}/{}'.format(TSERIES_RESULTS_2DFLOW_AREA, self._domain, table)
+        return reduce_tseries(self._plan_data[data], thresholds, absolute, max_memory_gb)
+
+    def scan_anomalous_attributes(self, thresholds: list = (30,), attrs: list = ('Face_Velocity',),
+                                  max_memory_gb: float = 0.5) -> dict:
+        """
+        Scans each attribute once for every threshold, returning the max and, per
+            threshold, the count of time steps above it along with the first and
+            last time step above it (-1 if never exceeded). Attributes not yet
+            loaded are streamed from the HDF. Scans are cached.
+        :param thresholds:
+        :param attrs:
+        :param max_memory_gb: Memory budget for each time block when streaming
+        :return: Dictionary of DataFrames keyed by attribute, indexed by face or cell,
+            with columns max, count_<threshold>, first_<threshold> and last_<threshold>
+        """
+        scans = {}
+        for attr in attrs:
+            key = (attr, tuple(thresholds))
+            if key not in self._scans:
+                if attr in TSERIES_TABLES and '_{}'.format(attr) not in self.__dict__:
+                    table, absolute = TSERIES_TABLES[attr]
+                    data = self._plan_data['{}/{}/{}'.format(TSERIES_RESULTS_2DFLOW_AREA, self._domain, table)]
+                else:
+                    data, absolute = np.asarray(getattr(self, attr)).T, False
+                self._scans[key] = reduce_tseries(data, absolute=absolute, max_memory_gb=max_memory_gb,
+                                                  thresholds=thresholds)
+            scans[attr] = self._scans[key]
+        return scans
 
     def find_anomalous_attributes(self, attr: str = 'Face_Velocity', threshold: int = 30):
         """
@@ -432,9 +588,9 @@ class DomainResults:
         :param threshold:
         :return:
         """
-        max_attr = pd.DataFrame(getattr(self, attr).max(axis=1), columns=['max'])
-        df_thresh = max_attr[max_attr['max'] > threshold]
-        gdf_thresh = self.Face_Centroid_Coordinates.iloc[df_thresh.index]
+        scan = self.scan_anomalous_attributes([threshold], [attr])[attr]
+        df_thresh = scan.loc[scan['max'] > threshold, ['max']]
+        gdf_thresh = face_centroids(self.Face_Geometry, df_thresh.index)
         try:
             return pd.concat([gdf_thresh, df_thresh], axis=1)
         except ValueError as e:
@@ -448,10 +604,10 @@ class DomainResults:
         :param threshold:
         :return:
         """
-        dseries = getattr(self, attr).apply(lambda row: sum(row > threshold), axis=1)
-        non_nan = dseries[dseries != 0].dropna()
-        df_non_nan = pd.DataFrame(non_nan, columns=['count'])
-        gdf_thresh = self.Face_Centroid_Coordinates.iloc[df_non_nan.index]
+        scan = self.scan_anomalous_attributes([threshold], [attr])[attr]
+        dseries = scan['count_{}'.format(threshold)]
+        df_non_nan = dseries[dseries != 0].to_frame('count')
+        gdf_thresh = face_centroids(self.Face_Geometry, df_non_nan.index)
         try:
             return pd.concat([gdf_thresh, df_non_nan], axis=1)
         except ValueError as e:
@@ -463,7 +619,120 @@ class DomainResults:
 
 # Functions ---------------------------------------------------------------------
 
-def all_aoi_gdf(domain_results:list) -> gpd.geodataframe.GeoDataFrame:
+def face_geometry(face_point_indexes: np.ndarray, face_point_coords: np.ndarray) -> pd.DataFrame:
+    """
+    Computes face endpoints, centroids, lengths and bounding boxes from the
+        face point indices and coordinates without building any geometries.
+    :param face_point_indexes: (n_faces, 2) array of face point indices
+    :param face_point_coords: (n_face_points, 2) array of face point coordinates
+    :return: DataFrame indexed by face with x0, y0, x1, y1, xc, yc, length, minx, miny, maxx, maxy
+    """
+    start = face_point_coords[face_point_indexes[:, 0]]
+    end = face_point_coords[face_point_indexes[:, 1]]
+    df = pd.DataFrame({'x0': start[:, 0], 'y0': start[:, 1], 'x1': end[:, 0], 'y1': end[:, 1]})
+
+    # The centroid of a two point line is its midpoint
+    df['xc'] = (start[:, 0] + end[:, 0]) / 2
+    df['yc'] = (start[:, 1] + end[:, 1]) / 2
+    df['length'] = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+    df['minx'] = np.minimum(start[:, 0], end[:, 0])
+    df['miny'] = np.minimum(start[:, 1], end[:, 1])
+    df['maxx'] = np.maximum(start[:, 0], end[:, 0])
+    df['maxy'] = np.maximum(start[:, 1], end[:, 1])
+    return df
+
+def face_lines(geometry: pd.DataFrame, idx=None) -> 'gpd.geodataframe.GeoDataFrame':
+    """
+    Builds face LineStrings for a subset of faces (all faces by default).
+    :param geometry: Face geometry table from face_geometry
+    :param idx: Face indices to build
+    """
+    subset = geometry if idx is None else geometry.loc[idx]
+    lines = [shapely_geometry.LineString([(x0, y0), (x1, y1)])
+             for x0, y0, x1, y1 in subset[['x0', 'y0', 'x1', 'y1']].values]
+    return gpd.GeoDataFrame(geometry=gpd.GeoSeries(lines, index=subset.index))
+
+def face_centroids(geometry: pd.DataFrame, idx=None) -> 'gpd.geodataframe.GeoDataFrame':
+    """
+    Builds face centroid Points for a subset of faces (all faces by default).
+    :param geometry: Face geometry table from face_geometry
+    :param idx: Face indices to build
+    """
+    subset = geometry if idx is None else geometry.loc[idx]
+    points = [shapely_geometry.Point(xc, yc) for xc, yc in subset[['xc', 'yc']].values]
+    return gpd.GeoDataFrame(geometry=gpd.GeoSeries(points, index=subset.index))
+
+def tseries_blocks(dataset: h5py.Dataset, max_memory_gb: float = 0.5, copies: int = 3):
+    """
+    Yields (start, block) pairs of time steps read from a (time x cells) HDF
+        dataset or array where each block, plus working copies, fits the memory
+        budget. Block lengths are rounded to the dataset chunk shape where possible.
+    :param dataset:
+    :param max_memory_gb:
+    :param copies: Number of block sized arrays held at once by the caller
+    """
+    n_steps = dataset.shape[0]
+    row_bytes = max(int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize, 1)
+    n_rows = max(int(max_memory_gb * 1e9 / (row_bytes * (copies + 1))), 1)
+    chunks = getattr(dataset, 'chunks', None)
+    if chunks is not None and n_rows > chunks[0]:
+        n_rows -= n_rows % chunks[0]
+    for start in range(0, n_steps, n_rows):
+        yield start, dataset[start:start + n_rows]
+
+def reduce_tseries(dataset: h5py.Dataset, thresholds: list = None, absolute: bool = False,
+                   max_memory_gb: float = 0.5) -> pd.DataFrame:
+    """
+    Computes the max, min and time step of the max for every cell or face in
+        one pass over a (time x cells) HDF dataset or array. Peak memory is set
+        by max_memory_gb rather than by the size of the model.
+
+        For each of thresholds the count of time steps above it and the first
+        and last time step above it (-1 if never exceeded) are also computed
+        in the same pass.
+    :param dataset:
+    :param thresholds:
+    :param absolute:
+    :param max_memory_gb:
+    :return: DataFrame indexed by cell or face
+    """
+    thresholds = list(thresholds) if thresholds is not None else []
+    n_cols = dataset.shape[1]
+    col_idx = np.arange(n_cols)
+    maxes = np.full(n_cols, -np.inf)
+    mins = np.full(n_cols, np.inf)
+    argmaxes = np.zeros(n_cols, dtype=np.int64)
+    t_counts = np.zeros((len(thresholds), n_cols), dtype=np.int64)
+    t_first = np.full((len(thresholds), n_cols), -1, dtype=np.int64)
+    t_last = np.full((len(thresholds), n_cols), -1, dtype=np.int64)
+
+    for start, block in tseries_blocks(dataset, max_memory_gb, copies=3 + bool(thresholds)):
+        if absolute:
+            block = np.abs(block)
+        block_argmax = block.argmax(axis=0)
+        block_max = block[block_argmax, col_idx]
+        update = block_max > maxes
+        maxes[update] = block_max[update]
+        argmaxes[update] = block_argmax[update] + start
+        np.minimum(mins, block.min(axis=0), out=mins)
+        for i, t in enumerate(thresholds):
+            above = block > t
+            exceeded = above.any(axis=0)
+            t_counts[i] += np.count_nonzero(above, axis=0)
+            first = exceeded & (t_first[i] < 0)
+            t_first[i, first] = above.argmax(axis=0)[first] + start
+            t_last[i, exceeded] = start + len(block) - 1 - above[::-1].argmax(axis=0)[exceeded]
+
+    df = pd.DataFrame({'max': maxes.astype(dataset.dtype),
+                       'min': mins.astype(dataset.dtype),
+                       'argmax': argmaxes})
+    for i, t in enumerate(thresholds):
+        df['count_{}'.format(t)] = t_counts[i]
+        df['first_{}'.format(t)] = t_first[i]
+        df['last_{}'.format(t)] = t_last[i]
+    return df
+
+def all_aoi_gdf(domain_results:list) -> 'gpd.geodataframe.GeoDataFrame':
     """
     Creates a geodataframe containing polygons for all domains.
     :param domain_results:
@@ -472,64 +741,119 @@ def all_aoi_gdf(domain_results:list) -> gpd.geodataframe.GeoDataFrame:
     df = pd.concat(perimeters).reset_index(drop=True)
     return gpd.GeoDataFrame(df)
 
-def group_excessive_points(gdf: gpd.geodataframe.GeoDataFrame, cell_size: float):
+def cluster_points(xy: np.ndarray, radius: float) -> np.ndarray:
+    """
+    Labels points joined by chains of neighbors within a radius, found with
+        a KD-tree and connected components. Labels are numbered in order of
+        each group's first point.
+    :param xy: (n, 2) array of point coordinates
+    :param radius:
+    :return: Group label for each point
+    """
+    n = len(xy)
+    pairs = spatial.cKDTree(xy).query_pairs(radius, output_type='ndarray')
+    graph = sparse.coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = sparse.csgraph.connected_components(graph, directed=False)
+    _, first = np.unique(labels, return_index=True)
+    remap = np.empty(len(first), dtype=np.int64)
+    remap[np.argsort(first)] = np.arange(len(first))
+    return remap[labels]
+
+def group_excessive_points(gdf: 'gpd.geodataframe.GeoDataFrame', cell_size: float,
+                           method: str = 'union', hulls: bool = True):
     """
     Creates groupings of collocated points exceeding a threshold.
         By default, a grouping is defined as three times the average
         cell size of the input file.
+
+        The 'union' method dissolves buffers around every point. The 'kdtree'
+        method finds the same groups from a radius-neighbor graph of the points
+        in roughly O(n log n), returning each group's members along with its
+        buffered convex hull (hulls=True) or its MultiPoint (hulls=False).
     :param gdf:
     :param cell_size:
+    :param method: 'union' or 'kdtree'
+    :param hulls:
     :return:
     """
+    if method == 'kdtree':
+        xy = np.array([(p.x, p.y) for p in gdf.geometry], dtype=np.float64).reshape(-1, 2)
+        labels = cluster_points(xy, cell_size * 3 * 2)
+        order = np.argsort(labels, kind='stable')
+        splits = np.cumsum(np.bincount(labels))[:-1]
+        members, geometries = [], []
+        for idx in (np.split(order, splits) if len(labels) else []):
+            members.append(list(gdf.index[idx]))
+            group = shapely_geometry.MultiPoint([tuple(p) for p in xy[idx]])
+            geometries.append(group.convex_hull.buffer(cell_size * 3) if hulls else group)
+        return gpd.GeoDataFrame({'members': members}, geometry=gpd.GeoSeries(geometries))
+
     gdf_aois = gpd.GeoDataFrame()
     gdf_aois['point'] = gdf.geometry
     gdf_aois['polygon'] = gdf_aois.point.apply(lambda row: row.buffer(cell_size * 3))
     gdf_aois['geometry'] = gdf_aois['polygon']
     
     try:
-        diss_aois = list(cascaded_union(gdf_aois.geometry))
+        diss_aois = list(shapely_ops.cascaded_union(gdf_aois.geometry))
         gdf_diss_aois = gpd.GeoDataFrame(diss_aois, columns=['geometry'])
     except:
-        diss_aois = cascaded_union(gdf_aois.geometry)
+        diss_aois = shapely_ops.cascaded_union(gdf_aois.geometry)
         gdf_diss_aois = gpd.GeoDataFrame([diss_aois], columns=['geometry'])
     return gdf_diss_aois
 
 
-def subset_data(grouping_polys: gpd.geodataframe.GeoDataFrame, thresheld_gdf: gpd.geodataframe.GeoDataFrame,
-                count_gdf: gpd.geodataframe.GeoDataFrame, face_gdf: gpd.geodataframe.GeoDataFrame,
-                buff_distance: int = 100) -> [list, list, list]:
+def subset_data(grouping_polys: 'gpd.geodataframe.GeoDataFrame', thresheld_gdf: 'gpd.geodataframe.GeoDataFrame',
+                count_gdf: 'gpd.geodataframe.GeoDataFrame', face_gdf: pd.DataFrame,
+                buff_distance: int = 100, face_index: BoundsIndex = None) -> [list, list, list]:
     """
     Creates three lists of dataframes subset by a polygon where the polygon
         is a grouping of centroids. The first list contains maximum values for
         each face centroid, the second list contains counts of instances above
         a threshold, and the third lists faces within the buffered bounding
         box of a group of centroids.
+
+        Centroids and faces are looked up with spatial indices built once, so
+        only candidates near each group are tested. Groups carrying their
+        members (see group_excessive_points) skip the centroid lookup.
         
     :param grouping_polys:
     :param thresheld_gdf:
     :param count_gdf:
-    :param face_gdf:
+    :param face_gdf: Face GeoDataFrame or face geometry table (see face_geometry),
+        for the latter only the selected faces are built as LineStrings
     :param buff_distance:
+    :param face_index: Spatial index of the faces, built from face_gdf if not given
     :return:
     """
+    is_geometry_table = 'geometry' not in face_gdf.columns
+    if face_index is None:
+        face_bounds = face_gdf[['minx', 'miny', 'maxx', 'maxy']] if is_geometry_table else face_gdf.bounds
+        face_index = BoundsIndex(*face_bounds.values.T)
+
+    xy = np.array([(p.x, p.y) for p in thresheld_gdf.geometry], dtype=np.float64).reshape(-1, 2)
+    point_index = BoundsIndex(xy[:, 0], xy[:, 1], xy[:, 0], xy[:, 1])
+
     subset_max_list, subset_count_list, subset_face_list = [], [], []
     for i, poly in enumerate(grouping_polys.geometry):
-        subset_max = thresheld_gdf[thresheld_gdf.within(poly)]
+        if 'members' in grouping_polys.columns:
+            subset_max = thresheld_gdf.loc[grouping_polys['members'].iloc[i]]
+        else:
+            candidates = thresheld_gdf.iloc[point_index.within(*poly.bounds)]
+            subset_max = candidates[candidates.within(poly)]
         subset_max_list.append(subset_max)
-
-        # NOT USED?
-        # subset_count = count_gdf.loc[subset_max.index]
         subset_count_list.append(count_gdf.loc[subset_max.index])
 
-        x0, y0, x1, y1 = poly.buffer(buff_distance).bounds
-        bbox = Polygon([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
-        subset_faces = face_gdf[face_gdf.within(bbox)]
+        face_idx = face_index.within(*poly.buffer(buff_distance).bounds)
+        if is_geometry_table:
+            subset_faces = face_lines(face_gdf, face_gdf.index[face_idx])
+        else:
+            subset_faces = face_gdf.iloc[face_idx]
         subset_face_list.append(subset_faces)
     return subset_max_list, subset_count_list, subset_face_list
 
 
 def find_large_and_small_groups(count_list: list, max_list: list, face_list: list,
-                                gdf_groups: gpd.geodataframe.GeoDataFrame,
+                                gdf_groups: 'gpd.geodataframe.GeoDataFrame',
                                 min_count: int = 5) -> [dict, dict]:
     """
     Identifies large groupings, i.e. above minimum count, of points and
@@ -559,12 +883,16 @@ def find_large_and_small_groups(count_list: list, max_list: list, face_list: lis
     small_dict['counts'] = [small_tuple[1] for small_tuple in small_tuples]
     return large_dict, small_dict
 
-def velCheckMain(results, domain, plot_tseries=5):
+def vel_check(results, plot_tseries=5, group_method='kdtree') -> dict:
     """
-    Add Description
+    Computes the velocity checks for a domain without plotting.
     :param results:
-    :param plot_tseries:
-    :param domain:
+    :param plot_tseries: Number of faces per large group with depth and velocity time series kept,
+        none are kept (and face depths are not computed) when 0
+    :param group_method: Grouping method passed to group_excessive_points
+    :return: Dictionary with the results table, large and small group dictionaries
+        (see find_large_and_small_groups) and (depths, velocities) per large group,
+        groups are None if no velocity errors were found
     """
     # Identify face velocities above a given threshold
     df_thresh = results.find_anomalous_attributes()
@@ -573,75 +901,159 @@ def velCheckMain(results, domain, plot_tseries=5):
     if df_count.shape[0] > 1 and df_thresh.shape[0] > 1:
 
         # Identify groups of excessive centroids
-        gdf_groups = group_excessive_points(df_thresh, results.CellSize)
+        gdf_groups = group_excessive_points(df_thresh, results.CellSize, method=group_method)
 
         # Using a method nearly doubles the time
-        max_list, count_list, face_list = subset_data(gdf_groups, df_thresh, df_count, results.Faces)
+        max_list, count_list, face_list = subset_data(gdf_groups, df_thresh, df_count, results.Face_Geometry,
+                                                      face_index=results.Face_Index)
 
         # Split groups into large (n > 5) clusters vs. everything else
         l_dict, s_dict = find_large_and_small_groups(count_list, max_list, face_list, gdf_groups)
 
-        # Identify group of interest
-        for idx in range(len(l_dict['groups'])):
-            plot_instabilities(l_dict['maxes'], l_dict['counts'], l_dict['faces'], results.Perimeter,
-                               l_dict['groups'], idx)
-
-            # NOT USED?
-            maxes = l_dict['maxes'][idx]
-            # counts = l_dict['counts'][idx]
-            # faces = l_dict['faces'][idx]
-            # group = l_dict['groups'][idx]
-
+        # Time series at the faces with the highest velocities of each large group
+        tseries = []
+        for maxes in l_dict['maxes'] if plot_tseries else []:
             max_vFaceIDs = list(maxes.sort_values(by='max', ascending=False)[0:plot_tseries].index)
+            tseries.append((results.Avg_Face_Depth.iloc[max_vFaceIDs], results.Face_Velocity.iloc[max_vFaceIDs]))
 
-            # NOT USED?
-            # groupID = idx
-            depths = results.Avg_Face_Depth.iloc[max_vFaceIDs]
-            velocities = results.Face_Velocity.iloc[max_vFaceIDs]
+        table = pd.DataFrame(data=[len(pd.concat(count_list)), max(pd.concat(max_list)['max'])],
+                             columns=['Results'],
+                             index=['Instability Count', 'Max Velocity'])
+        return {'table': table, 'large': l_dict, 'small': s_dict, 'tseries': tseries}
+    else:
+        max_vel = results.scan_anomalous_attributes()['Face_Velocity']['max'].max()
+        table = pd.DataFrame(data=[0, max_vel],
+                             columns=['Results'],
+                             index=['Instability Count', 'Max Velocity'])
+        return {'table': table, 'large': None, 'small': None, 'tseries': None}
+
+def plot_vel_check(check: dict, perimeter: 'gpd.geodataframe.GeoDataFrame', domain: str) -> pd.DataFrame:
+    """
+    Plots the results of vel_check returning its results table.
+    :param check:
+    :param perimeter:
+    :param domain:
+    """
+    l_dict, s_dict = check['large'], check['small']
+    if l_dict is None:
+        print('No Velocity Errors Found in Domain {}'.format(domain))
+        return check['table']
 
+    # Identify group of interest
+    for idx in range(len(l_dict['groups'])):
+        plot_instabilities(l_dict['maxes'], l_dict['counts'], l_dict['faces'], perimeter,
+                           l_dict['groups'], idx)
+        for depths, velocities in check['tseries'][idx:idx + 1]:
             for i in depths.index:
                 DepthVelPlot(depths.loc[i], velocities.loc[i], i)
-        try:
-            plot_disparate_instabilities(s_dict['maxes'], s_dict['counts'], results.Perimeter, domain)
-        except:
-            print('No disparate instabilities found. All instabilities must be grouped!')
-        return pd.DataFrame(data=[len(pd.concat(count_list)), max(pd.concat(max_list)['max'])],
-                            columns=['Results'],
-                            index=['Instability Count', 'Max Velocity'])
-    else:
-        max_vel = results.Face_Velocity.values.max()
-        return pd.DataFrame(data=[0, max_vel],
-                            columns=['Results'],
-                            index=['Instability Count', 'Max Velocity'])
-        print('No Velocity Errors Found in Domain {}'.format(domain))
+    try:
+        plot_disparate_instabilities(s_dict['maxes'], s_dict['counts'], perimeter, domain)
+    except:
+        print('No disparate instabilities found. All instabilities must be grouped!')
+    return check['table']
+
+def velCheckMain(results, domain, plot_tseries=5, group_method='kdtree'):
+    """
+    Computes and plots the velocity checks for a domain
+    :param results:
+    :param plot_tseries:
+    :param domain:
+    :param group_method: Grouping method passed to group_excessive_points
+    """
+    check = vel_check(results, plot_tseries, group_method)
+    return plot_vel_check(check, results.Perimeter, domain)
+
+
+class DomainSummary:
+    """
+    Lightweight, picklable results of the checks for one domain, holding only
+    what is needed to plot and report them: domain, StageBC, FlowBC, PrecipBC,
+    Describe_Depths, Extreme_Edges, Perimeter and vel_check (see vel_check).
+    """
+
+    def __init__(self, results: DomainResults, plot_tseries: int = 3, group_method: str = 'kdtree'):
+        self.domain = results.domain
+        self.StageBC = results.StageBC
+        self.FlowBC = results.FlowBC
+        self.PrecipBC = results.PrecipBC
+        self.Describe_Depths = results.Describe_Depths
+        self.Extreme_Edges = results.Extreme_Edges
+        self.Perimeter = results.Perimeter
+        self.vel_check = vel_check(results, plot_tseries, group_method)
+
+    @property
+    def table(self):
+        """Instability count and max velocity"""
+        return self.vel_check['table']
+
+
+def combine_results_tables(tables: list) -> pd.DataFrame:
+    """Combines the velocity check tables of several domains into one"""
+    instability_count = sum([value.loc['Instability Count'] for value in tables])[0]
+    max_velocity = max([value.loc['Max Velocity'].values[0] for value in tables])
+    return pd.DataFrame(data=[instability_count, max_velocity],
+                        columns=['Results'],
+                        index=['Instability Count', 'Max Velocity'])
+
+
+def results_data(domains: list, model, rasPlan, group_method: str = 'kdtree') -> pd.DataFrame:
+    """
+    Computes the results table returned by show_results without plotting,
+        only the velocity checks are run and no time series are kept.
+    """
+    tables = [vel_check(DomainResults(model, rasPlan, domain, lazy=True), 0, group_method)['table']
+              for domain in domains]
+    return tables[0] if len(tables) == 1 else combine_results_tables(tables)
+
+
+def summarize_domain(hdf_path: str, domain: str, plot_tseries: int = 3,
+                     group_method: str = 'kdtree') -> DomainSummary:
+    """
+    Runs the checks for one domain of a local plan HDF. Used as the worker
+        in parallel runs of show_results, so it opens its own copy of the plan.
+    """
+    plan = HDFResultsFile(None, hdf_path, hdf_path)
+    try:
+        return DomainSummary(DomainResults(None, plan, domain, lazy=True), plot_tseries, group_method)
+    finally:
+        plan.hdfLocal.close()
 
 # Plotting Functions ------------------------------------------------------------
 
-def show_results(domains:list, model, rasPlan, plot_tseries:int=3) -> None:
+def show_results(domains:list, model, rasPlan, plot_tseries:int=3, processes:int=None) -> None:
     """Wrapper function plotting descriptive statistics, extreme edges, boundary
     conditions and velocity values.
+
+    With processes set, domains are computed in a pool of that many processes,
+    each reading the plan HDF from disk, and plotted afterwards.
     """
+    hdf_path = rasPlan.hdfLocal.filename
+    if processes and len(domains) > 1 and os.path.isfile(hdf_path):
+        with ProcessPoolExecutor(processes) as pool:
+            summaries = dict(zip(domains, pool.map(summarize_domain, repeat(hdf_path), domains,
+                                                   repeat(plot_tseries))))
+    else:
+        if processes and len(domains) > 1:
+            print('Plan HDF is not on disk, computing domains serially...')
+        summaries = {domain: DomainSummary(DomainResults(model, rasPlan, domain, lazy=True), plot_tseries)
+                     for domain in domains}
+
     if len(domains) > 1:
-        results = {domain: DomainResults(model, rasPlan, domain) for domain in domains}
         results_table = {}
-        for domain, result in results.items():
-            plot_descriptive_stats(result.Describe_Depths, result.Perimeter, domain)
-            plot_extreme_edges(result.Extreme_Edges, result.Perimeter, mini_map=rasPlan.domain_polys)
-            plotBCs(result, domain) 
-            results_table[domain] = velCheckMain(result, domain, plot_tseries)
-        instability_count = sum([value.loc['Instability Count'] for value in list(results_table.values())])[0]
-        max_velocity = max([value.loc['Max Velocity'].values[0] for value in list(results_table.values())])
-        return pd.DataFrame(data=[instability_count, max_velocity],
-                            columns=['Results'],
-                            index=['Instability Count', 'Max Velocity'])
+        for domain, summary in summaries.items():
+            plot_descriptive_stats(summary.Describe_Depths, summary.Perimeter, domain)
+            plot_extreme_edges(summary.Extreme_Edges, summary.Perimeter, mini_map=rasPlan.domain_polys)
+            plotBCs(summary, domain)
+            results_table[domain] = plot_vel_check(summary.vel_check, summary.Perimeter, domain)
+        return combine_results_tables(list(results_table.values()))
 
     else:
         domain = domains[0]
-        result = DomainResults(model, rasPlan, domain)
-        plot_descriptive_stats(result.Describe_Depths, result.Perimeter, domain)
-        plot_extreme_edges(result.Extreme_Edges, result.Perimeter)
-        plotBCs(result, domain)
-        return velCheckMain(result, domain, plot_tseries)
+        summary = summaries[domain]
+        plot_descriptive_stats(summary.Describe_Depths, summary.Perimeter, domain)
+        plot_extreme_edges(summary.Extreme_Edges, summary.Perimeter)
+        plotBCs(summary, domain)
+        return plot_vel_check(summary.vel_check, summary.Perimeter, domain)
 
 def plot_instabilities(max_list, count_list, gdf_face, gdf_face_all, ex_groups, idx):
     """
@@ -713,7 +1125,7 @@ def plot_disparate_instabilities(max_list, count_list, bounding_polygon, domain)
     fig.suptitle('Isolated Points above Threshold for Domain {}'.format(domain), fontsize=16, fontweight='bold')
 
 
-def plot_descriptive_stats(stat_lists: tuple, aoi: gpd.geodataframe.GeoDataFrame, domain:str) -> None:
+def plot_descriptive_stats(stat_lists: tuple, aoi: 'gpd.geodataframe.GeoDataFrame', domain:str) -> None:
     """
     Plots the descriptive statistics (Max, Min) for
         cell centers with the area of interest underneath.
@@ -741,8 +1153,8 @@ def plot_descriptive_stats(stat_lists: tuple, aoi: gpd.geodataframe.GeoDataFrame
                  fontsize=16, fontweight='bold')
 
 
-def plot_extreme_edges(gdf: gpd.geodataframe.GeoDataFrame,
-                       aoi: gpd.geodataframe.GeoDataFrame,
+def plot_extreme_edges(gdf: 'gpd.geodataframe.GeoDataFrame',
+                       aoi: 'gpd.geodataframe.GeoDataFrame',
                        **kwargs) -> None:
     """
     Plots extreme depths along edges along with an overview map showing current
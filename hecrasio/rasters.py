@@ -0,0 +1,192 @@
+"""
+PFRA Module for thread-safe raster access
+
+Rasters on S3 are opened in one of three ways, set per call or for all
+workers with the HECRASIO_RASTER_ACCESS environment variable:
+
+- cache: downloaded once to the shared on-disk cache (see hecrasio.cache), the default
+- vsis3: streamed with GDAL's /vsis3/ range requests, only the blocks read are fetched
+- memory: downloaded to a GDAL in-memory file with a unique name. The file is
+  reference counted, so threads opening the same object share one copy,
+  and it is unlinked when the last raster using it is closed
+
+Every Raster opens its own GDAL dataset, as datasets must not be shared between threads.
+"""
+
+import os
+import uuid
+import threading
+import pathlib as pl
+from hecrasio.cache import cached_object
+from hecrasio.lazy import LazyModule, get_s3
+
+gdal = LazyModule('gdal', on_import=lambda gdal: gdal.UseExceptions())
+
+ACCESS_MODES = ['cache', 'vsis3', 'memory']
+
+
+def raster_access(access: str = None) -> str:
+    """Access mode for S3 rasters, defaulting to HECRASIO_RASTER_ACCESS or cache"""
+    access = access or os.environ.get('HECRASIO_RASTER_ACCESS', 'cache')
+    assert access in ACCESS_MODES, 'Unknown raster access {}, expected one of {}'.format(access, ACCESS_MODES)
+    return access
+
+
+def s3_object(s3path):
+    """boto3 s3.Object for an s3://bucket/key path, objects are returned as is"""
+    if not isinstance(s3path, str):
+        return s3path
+    path_parts = pl.PurePosixPath(s3path.replace('s3://', '')).parts
+    return get_s3().Object(bucket_name=path_parts[0], key='/'.join(path_parts[1:]))
+
+
+class MemoryFiles:
+    """
+    Reference counted GDAL in-memory files of S3 objects. Each object is
+    downloaded once while in use, to a unique /vsimem/ path, and unlinked
+    when its last user releases it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._key_locks = {}
+
+    @property
+    def open_files(self):
+        """In-memory paths with their number of users"""
+        with self._lock:
+            return {path: count for path, count in self._files.values()}
+
+    def acquire(self, obj) -> str:
+        """Returns the in-memory path of a boto3 s3.Object, downloading it if not already in memory"""
+        key = (obj.bucket_name, obj.key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread downloads an object, others wait for it rather than download it again
+        with key_lock:
+            with self._lock:
+                if key in self._files:
+                    self._files[key][1] += 1
+                    return self._files[key][0]
+            try:
+                data = obj.get()['Body'].read()
+            except Exception:
+                with self._lock:
+                    if key not in self._files:
+                        self._key_locks.pop(key, None)
+                raise
+            path = '/vsimem/hecrasio/{}/{}'.format(uuid.uuid4().hex, pl.PurePosixPath(obj.key).name)
+            gdal.FileFromMemBuffer(path, data)
+            with self._lock:
+                if key not in self._files:
+                    self._files[key] = [path, 1]
+                    return path
+                # Downloaded concurrently under a newer key lock, after release dropped this one
+                self._files[key][1] += 1
+                existing = self._files[key][0]
+        gdal.Unlink(path)
+        return existing
+
+    def release(self, path: str) -> None:
+        """Releases an in-memory path from acquire, unlinking it once no longer used"""
+        with self._lock:
+            for key, (file_path, count) in self._files.items():
+                if file_path == path:
+                    break
+            else:
+                return
+            if count > 1:
+                self._files[key][1] -= 1
+                return
+            del self._files[key]
+            self._key_locks.pop(key, None)
+        gdal.Unlink(path)
+
+
+memory_files = MemoryFiles()
+
+
+class Raster:
+    """
+    A single band raster opened from a local path, an s3://bucket/key path or
+    a boto3 s3.Object. Use as a context manager, or call close, so that
+    in-memory copies are freed as soon as the raster is no longer needed.
+    :param path: Local path, S3 path or s3.Object
+    :param access: How S3 rasters are read, one of ACCESS_MODES, see raster_access
+    """
+
+    def __init__(self, path, access: str = None):
+        self._path = path
+        self._mem_path = None
+        self._access = None
+
+        if isinstance(path, str) and not path.startswith('s3://'):
+            self._src = gdal.Open(path)
+        else:
+            self._access = raster_access(access)
+            obj = s3_object(path)
+            if self._access == 'vsis3':
+                if gdal.GetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN') is None:
+                    # Avoids listing the S3 prefix on every open
+                    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+                self._src = gdal.Open('/vsis3/{}/{}'.format(obj.bucket_name, obj.key))
+            elif self._access == 'memory':
+                self._mem_path = memory_files.acquire(obj)
+                try:
+                    self._src = gdal.Open(self._mem_path)
+                except Exception:
+                    memory_files.release(self._mem_path)
+                    self._mem_path = None
+                    raise
+            else:
+                self._src = gdal.Open(cached_object(obj))
+        self._rb = self._src.GetRasterBand(1)
+
+    @property
+    def access(self):
+        """Access mode of an S3 raster, None if local"""
+        return self._access
+
+    @property
+    def src(self):
+        return self._src
+
+    @property
+    def rb(self):
+        return self._rb
+
+    @property
+    def gt(self):
+        return self._src.GetGeoTransform()
+
+    @property
+    def null_value(self):
+        return self._rb.GetNoDataValue()
+
+    def read(self, window: tuple):
+        """Reads a window ((row_start, row_stop), (col_start, col_stop)) of the band"""
+        (ystart, ystop), (xstart, xstop) = window
+        return self._rb.ReadAsArray(int(xstart), int(ystart), int(xstop - xstart), int(ystop - ystart))
+
+    def close(self) -> None:
+        """Closes the dataset, then releases its in-memory copy, if any"""
+        self._rb, self._src = None, None
+        if self._mem_path is not None:
+            memory_files.release(self._mem_path)
+            self._mem_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def open_raster(path, access: str = None) -> Raster:
+    """Opens a local or S3 raster, see Raster"""
+    return Raster(path, access)
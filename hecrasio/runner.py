@@ -0,0 +1,235 @@
+"""
+PFRA Module for running QA/QC checks without a notebook
+
+Runs the same checks as the QAQC-PFRA notebook (plan information, plan
+parameters, velocity checks and the unsteady summary) without starting a
+kernel or rendering figures, returning one flat record per model. The record
+has the same fields make_qaqc_table builds from notebook scraps.
+
+[usage] python -m hecrasio.runner s3://pfra/DC/P01/H06/E0001/DC_P01_H06_E0001_out.zip -o DC_P01_H06_E0001.json
+[usage] python -m hecrasio.runner --prefix s3://pfra/DC/P01/ -p 8 --log-file DC_P01.jsonl --store qaqc.db
+"""
+
+import argparse
+import json
+import os
+import pathlib as pl
+from time import time, sleep
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from hecrasio.core import ResultsZip, pull_result_paths
+from hecrasio.qaqc import HDFResultsFile, results_data
+from hecrasio.store import QAQCStore
+from hecrasio.lazy import LazyModule
+
+boto3 = LazyModule('boto3')
+
+
+# S3 error codes worth retrying
+TRANSIENT_CODES = ['SlowDown', 'Throttling', 'RequestTimeout', 'InternalError', 'ServiceUnavailable']
+
+
+def is_transient(e: Exception) -> bool:
+    """True for network and S3 throttling errors that may succeed when retried"""
+    from botocore.exceptions import BotoCoreError, ClientError
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in TRANSIENT_CODES
+    return isinstance(e, (ConnectionError, TimeoutError, BotoCoreError))
+
+
+def table_record(df: pd.DataFrame) -> dict:
+    """Flattens a single column results table as it would be glued to a notebook scrap"""
+    return list(json.loads(df.to_json()).values())[0]
+
+
+def run_qaqc(model_s3path: str, stream: bool = False, raise_transient: bool = False,
+             keep_plan: bool = True) -> dict:
+    """
+    Runs the QA/QC checks for a model, returning a record of the results.
+    Errors are collected in 'Global Errors' rather than raised, as in the notebook.
+    :param model_s3path: Path to a PFRA _out.zip, e.g. s3://pfra/DC/P01/H06/E0001/DC_P01_H06_E0001_out.zip
+    :param stream: Read the plan in place from S3 rather than through the local cache
+    :param raise_transient: Raise transient errors (see is_transient) so the model can be retried
+    :param keep_plan: Keep the plan file extracted to the working directory, e.g. for RasMapper
+    """
+    record = {'Model': model_s3path}
+    global_errors = []
+
+    try:
+        model = ResultsZip(model_s3path, pfra=True, require_prj=False, stream=stream)
+        hdfResults_path = pull_result_paths(model)
+        rasPlan = HDFResultsFile(model, model_s3path, hdfResults_path, stream=stream)
+    except Exception as e:
+        if raise_transient and is_transient(e):
+            raise
+        global_errors.append('Failed to read RAS plan: {}'.format(e))
+        record['Global Errors'] = global_errors
+        return record
+
+    try:
+        for name, table in [('Plan Information', lambda: rasPlan.Plan_Information),
+                            ('Plan Parameters', lambda: rasPlan.Plan_Parameters),
+                            ('Results Data', lambda: results_data(rasPlan.domains, model, rasPlan)),
+                            ('Plan Summary', lambda: rasPlan.summary.replace(np.nan, "00:00:00"))]:
+            try:
+                record.update(table_record(table()))
+            except Exception as e:
+                if raise_transient and is_transient(e):
+                    raise
+                global_errors.append('Failed to compute {}: {}'.format(name, e))
+    finally:
+        rasPlan.hdfLocal.close()
+        if not keep_plan and '.zip' in model_s3path and os.path.isfile(hdfResults_path):
+            os.remove(hdfResults_path)
+
+    record['Global Errors'] = global_errors
+    return record
+
+
+def run_qaqc_with_retries(model_s3path: str, retries: int = 3, delay: float = 10, stream: bool = False) -> dict:
+    """
+    Runs run_qaqc, retrying transient errors with exponential backoff. The
+    last error is recorded in 'Global Errors' once retries are exhausted.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return run_qaqc(model_s3path, stream=stream, raise_transient=True, keep_plan=False)
+        except Exception as e:
+            if attempt == retries:
+                return {'Model': model_s3path, 'Global Errors': ['Failed after {} attempts: {}'.format(attempt + 1, e)]}
+            print('Retrying {} after error: {}'.format(model_s3path, e))
+            sleep(delay * 2**attempt)
+
+
+def list_models(s3_prefix: str, suffix: str = '_out.zip') -> list:
+    """Lists model outputs under an S3 prefix, e.g. s3://pfra/DC/P01/"""
+    path_parts = pl.PurePosixPath(s3_prefix.replace('s3://', '')).parts
+    bucket, prefix = path_parts[0], '/'.join(path_parts[1:])
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    models = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        models.extend(['s3://{}/{}'.format(bucket, obj['Key']) for obj in page.get('Contents', [])
+                       if obj['Key'].endswith(suffix)])
+    return models
+
+
+def read_manifest(manifest: str) -> list:
+    """Reads model paths from a text file, one per line"""
+    with open(manifest) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def read_log(log_file: str) -> list:
+    """Reads the records written to a batch log file"""
+    if not os.path.exists(log_file):
+        return []
+    with open(log_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def records_table(records: list) -> pd.DataFrame:
+    """Consolidates QA/QC records into one table indexed by model name"""
+    df = pd.DataFrame(records)
+    df.index = [pl.PurePosixPath(m).stem.replace('_out', '') for m in df['Model']]
+    return df
+
+
+def run_batch(models: list, processes: int = 4, retries: int = 3, stream: bool = False,
+              log_file: str = None, out_file: str = None, store: str = None) -> pd.DataFrame:
+    """
+    Runs the QA/QC checks for many models in a pool of processes.
+    :param models: Model paths, e.g. from list_models or read_manifest
+    :param processes: Number of worker processes
+    :param retries: Number of retries of transient errors per model
+    :param stream: Read plans in place from S3 rather than through the local cache
+    :param log_file: Each record is appended to this JSON lines file as it completes, models
+        already in the file are skipped so an interrupted batch can be resumed
+    :param out_file: Write the consolidated records to a .json, .parquet or .db (QAQCStore) file
+    :param store: Each record is added to this QAQCStore database as it completes
+    """
+    wanted = set(models)
+    records = [r for r in read_log(log_file) if r['Model'] in wanted] if log_file else []
+    done = set(r['Model'] for r in records)
+    todo = [m for m in dict.fromkeys(models) if m not in done]
+    if done:
+        print('Skipping {} models found in {}'.format(len(models) - len(todo), log_file))
+
+    qaqc_store = QAQCStore(store) if store else None
+    start = time()
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(run_qaqc_with_retries, m, retries, stream=stream): m for m in todo}
+        for i, future in enumerate(as_completed(futures)):
+            model = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # e.g. a worker killed while reading the plan
+                record = {'Model': model, 'Global Errors': ['Worker failed: {}'.format(e)]}
+            records.append(record)
+            if log_file:
+                with open(log_file, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            if qaqc_store:
+                qaqc_store.append([record])
+            print('[{}/{}] {} ({} errors, {:.0f}s elapsed)'.format(i + 1, len(todo), model,
+                                                                 len(record['Global Errors']), time() - start))
+
+    if qaqc_store:
+        qaqc_store.close()
+    if out_file:
+        write_records(records, out_file)
+    return records_table(records)
+
+
+def write_records(records: list, out_file: str) -> None:
+    """
+    Writes QA/QC records to a .json (list of records), .parquet (one row per record)
+    or .db (see QAQCStore) file
+    """
+    if pl.Path(out_file).suffix == '.db':
+        qaqc_store = QAQCStore(out_file)
+        qaqc_store.append(records)
+        qaqc_store.close()
+    elif pl.Path(out_file).suffix == '.parquet':
+        df = pd.DataFrame(records)
+        df['Global Errors'] = df['Global Errors'].apply(json.dumps)
+        df.to_parquet(out_file)
+    else:
+        with open(out_file, 'w') as f:
+            json.dump(records, f, indent=2)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run QA/QC checks on PFRA model results without a notebook')
+    parser.add_argument('models', nargs='*', help='Paths to model _out.zip files')
+    parser.add_argument('--prefix', help='Run all _out.zip files under an S3 prefix')
+    parser.add_argument('--manifest', help='Run the models listed in a text file, one per line')
+    parser.add_argument('-o', '--out-file', help='Write the records to a .json, .parquet or .db file, '
+                                                 'otherwise a single record is printed')
+    parser.add_argument('-p', '--processes', type=int, default=4, help='Worker processes for batches')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of transient errors per model')
+    parser.add_argument('--log-file', help='JSON lines file recording batch progress, used to resume')
+    parser.add_argument('--store', help='QAQCStore database each batch record is added to as it completes')
+    parser.add_argument('--stream', action='store_true', help='Read the plan in place from S3')
+    args = parser.parse_args(args)
+
+    models = list(args.models)
+    if args.prefix:
+        models.extend(list_models(args.prefix))
+    if args.manifest:
+        models.extend(read_manifest(args.manifest))
+    if len(models) != 1 or args.log_file or args.store:
+        return run_batch(models, args.processes, args.retries, args.stream, args.log_file, args.out_file,
+                         args.store)
+
+    record = run_qaqc(models[0], stream=args.stream)
+    if args.out_file:
+        write_records([record], args.out_file)
+    else:
+        print(json.dumps(record, indent=2))
+    return record
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,8 @@ from botocore.exceptions import ClientError
 import scrapbook as sb
 from hecrasio.core import *
 from hecrasio.qaqc import *
+from hecrasio.cache import cached_object, cached_s3_path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 OUTPUT_EXTS = ['.html', '.ipynb', '.csv', '.tif', '.vrt']
@@ -73,8 +75,7 @@ def get_point_from_s3(s3_data_path:str) -> None:
     path_info =pl.Path(s3_data_path.split('//')[1])
     s3 = boto3.resource('s3')
     s3Obj = s3.Object(path_info.parts[0], '/'.join(path_info.parts[1:]))
-    buffer = BytesIO(s3Obj.get()['Body'].read())
-    inmem_zip = zipfile.ZipFile(buffer)
+    inmem_zip = zipfile.ZipFile(cached_object(s3Obj))
 
     for file in inmem_zip.infolist():
         inmem_zip.extract(file)
@@ -214,6 +215,35 @@ def s3_nbs(bucket:str, prefix:str, nameSelector:str='', fileformat:str='.ipynb')
 
     return pathsList
 
+def read_notebook(nb_path:str, cache:bool=False) -> tuple:
+    """Reads a notebook returning its name and scrapbook notebook,
+    optionally through the local S3 object cache.
+    """
+    name = pl.PurePosixPath(nb_path).stem
+    if cache and nb_path.startswith('s3://'):
+        return name, sb.read_notebook(cached_s3_path(nb_path))
+    return name, sb.read_notebook(nb_path)
+
+def iter_notebooks(nb_paths:list, max_workers:int=16, cache:bool=False):
+    """Yields (name, notebook) pairs as notebooks are read, keeping up to
+    max_workers reads in flight. Notebooks that fail to read are reported
+    and skipped.
+    """
+    nb_paths = iter(nb_paths)
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = {pool.submit(read_notebook, nb, cache): nb for _, nb in zip(range(max_workers), nb_paths)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                nb = pending.pop(future)
+                next_nb = next(nb_paths, None)
+                if next_nb is not None:
+                    pending[pool.submit(read_notebook, next_nb, cache)] = next_nb
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print('Failed to read {}: {}'.format(nb, e))
+
 def pull_scraps(**kwargs):
     """Pull scraps from one or more notebooks on S3 with dynamic
     single- or multi-folder support.
@@ -227,16 +257,35 @@ def pull_scraps(**kwargs):
             :bucket str: Bucket of interest.
             :prefix str: Prefix selector.
             :name_selector str: Name selector.
+        :max_workers int: Notebooks read concurrently (default 16),
+            1 reads them one at a time as before.
+        :cache bool: Read notebooks through the local S3 object cache.
+        :stream bool: Return a generator yielding (name, notebook) pairs
+            as notebooks arrive rather than a list.
     """
     keys = list(kwargs.keys())
+    max_workers = kwargs.get('max_workers', 16)
+    cache = kwargs.get('cache', False)
     if 'single_folder' in keys:
         s3_path = kwargs['single_folder']
-        
-        return list(sb.read_notebooks(s3_path).items())
+        if max_workers == 1 and not cache and not kwargs.get('stream'):
+            return list(sb.read_notebooks(s3_path).items())
+
+        path_parts = pl.PurePosixPath(s3_path.replace('s3://', '')).parts
+        folder = '/'.join(path_parts[1:]) + '/'
+        listed_nbs = [nb for nb in s3_nbs(path_parts[0], folder) if '/' not in nb.split(folder, 1)[-1]]
     elif 'multi_folder' in keys:
         bucket = kwargs['bucket']
         prefix = kwargs['prefix']
         name_selector = kwargs['name_selector']
         
         listed_nbs = s3_nbs(bucket, prefix, name_selector)
-        return [(nb.split('/')[-1].split('.')[0], sb.read_notebook(nb)) for nb in listed_nbs]
\ No newline at end of file
+    else:
+        raise ValueError('Expected single_folder or multi_folder')
+
+    if kwargs.get('stream'):
+        return iter_notebooks(listed_nbs, max_workers, cache)
+    elif max_workers == 1:
+        return [read_notebook(nb, cache) for nb in listed_nbs]
+    with ThreadPoolExecutor(max_workers) as pool:
+        return list(pool.map(lambda nb: read_notebook(nb, cache), listed_nbs))
@@ -0,0 +1,140 @@
+"""
+PFRA Module for storing QA/QC results
+
+QA/QC records (see hecrasio.runner) are stored as typed rows in a SQLite
+table keyed by study, model, subtype and event, so that the results of
+thousands of runs can be appended as they complete and loaded, or filtered,
+without reading any notebooks.
+"""
+
+import json
+import sqlite3
+import pathlib as pl
+import pandas as pd
+
+KEY_COLUMNS = ['Study', 'ModelID', 'SubType', 'Event']
+TABLE = 'qaqc'
+
+
+def model_keys(model_s3path: str) -> dict:
+    """
+    Parses the study, model, subtype and event from a PFRA model path,
+    e.g. s3://pfra/DC/P01/H06/E0001/DC_P01_H06_E0001_out.zip. Missing parts
+    of names not following the PFRA convention are left empty.
+    """
+    name = pl.PurePosixPath(model_s3path).stem.replace('_out', '')
+    parts = name.split('_', len(KEY_COLUMNS) - 1)
+    parts += [''] * (len(KEY_COLUMNS) - len(parts))
+    return dict(zip(KEY_COLUMNS, parts))
+
+
+def sql_type(value) -> str:
+    """SQLite column type for a record value"""
+    if isinstance(value, (bool, int)):
+        return 'INTEGER'
+    elif isinstance(value, float):
+        return 'REAL'
+    else:
+        return 'TEXT'
+
+
+def quote(name: str) -> str:
+    """Quotes a column name, e.g. 'Max Velocity'"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class QAQCStore:
+    """
+    SQLite store of QA/QC records with one row per model run. Columns are
+    added as new record fields are seen and re-running a model replaces its row.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._con = sqlite3.connect(path)
+        self._con.execute('CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))'.format(
+            TABLE, ', '.join('{} TEXT NOT NULL'.format(quote(c)) for c in KEY_COLUMNS),
+            ', '.join(quote(c) for c in KEY_COLUMNS)))
+        self._con.commit()
+
+    @property
+    def path(self):
+        """Database path"""
+        return self._path
+
+    @property
+    def columns(self):
+        """Column names"""
+        return [row[1] for row in self._con.execute('PRAGMA table_info({})'.format(TABLE))]
+
+    def append(self, records: list) -> None:
+        """
+        Adds QA/QC records to the store, replacing earlier runs of the same model.
+        Lists, e.g. 'Global Errors', are stored as JSON.
+        """
+        rows = []
+        for record in records:
+            row = model_keys(record['Model'])
+            row.update({k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in record.items()})
+            rows.append(row)
+
+        # New columns are typed by their first non-null value, TEXT if there is none
+        new_columns = {}
+        columns = self.columns
+        for row in rows:
+            for name, value in row.items():
+                if name not in columns and new_columns.get(name) is None:
+                    new_columns[name] = value
+
+        with self._con:
+            for name, value in new_columns.items():
+                self._con.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(TABLE, quote(name), sql_type(value)))
+            for row in rows:
+                names = list(row)
+                self._con.execute('INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                    TABLE, ', '.join(quote(n) for n in names), ', '.join('?' * len(names))),
+                    [row[n] for n in names])
+
+    def load(self, columns: list = None, where: str = None, params: tuple = (), **keys) -> pd.DataFrame:
+        """
+        Loads records as a table indexed by model name, e.g. DC_P01_H06_E0001
+        :param columns: Columns to load, all if None
+        :param where: SQL condition, e.g. '"Instability Count" > ?'
+        :param params: Values for placeholders in where
+        :param keys: Key column filters, e.g. Study='DC', SubType='H06'
+        """
+        for k in keys:
+            assert k in KEY_COLUMNS, 'Unknown key {}, expected one of {}'.format(k, KEY_COLUMNS)
+        conditions = ['{} = ?'.format(quote(k)) for k in keys]
+        params = tuple(keys.values()) + tuple(params)
+        if where:
+            conditions.append('({})'.format(where))
+
+        selected = KEY_COLUMNS + [c for c in (columns or self.columns) if c not in KEY_COLUMNS]
+        query = 'SELECT {} FROM {}'.format(', '.join(quote(c) for c in selected), TABLE)
+        if conditions:
+            query += ' WHERE {}'.format(' AND '.join(conditions))
+        df = pd.read_sql_query(query, self._con, params=params)
+
+        if 'Global Errors' in df.columns:
+            df['Global Errors'] = df['Global Errors'].apply(lambda x: json.loads(x) if x else [])
+        df.index = df[KEY_COLUMNS].apply(lambda keys: '_'.join(k for k in keys if k), axis=1)
+        return df
+
+    def table(self, **kwargs) -> pd.DataFrame:
+        """
+        QA/QC results table as returned by make_qaqc_table, dropping models
+        without plan parameters. Takes the arguments of load.
+        """
+        df = self.load(**kwargs).drop(columns=KEY_COLUMNS + ['Model'], errors='ignore')
+        if '1D Cores' not in df.columns:
+            return df.iloc[:0]
+        drop_nbs = list(df[df['1D Cores'].isnull()].index)
+        if drop_nbs:
+            print('WARNING! The following models had null 1D Cores values. ' +
+                  'These models were dropped from the QA/QC table with the' +
+                  ' assumption these models are bad: {}'.format(drop_nbs))
+        return df[df['1D Cores'].notnull()]
+
+    def close(self):
+        self._con.close()
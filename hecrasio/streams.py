@@ -0,0 +1,231 @@
+"""
+PFRA Module for reading files in place from zip archives and S3 objects
+"""
+
+import atexit
+import io
+import struct
+import threading
+import weakref
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from hecrasio.lazy import LazyModule
+
+h5py = LazyModule('h5py')
+
+# Size of the fixed portion of a zip local file header
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable view over a byte range of another seekable file,
+    e.g. a stored (uncompressed) member within a zip archive.
+    """
+
+    def __init__(self, fileobj, offset: int, size: int, name: str = None):
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = pos
+        elif whence == io.SEEK_CUR:
+            self._pos += pos
+        elif whence == io.SEEK_END:
+            self._pos = self._size + pos
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+        return self._pos
+
+    def readinto(self, b):
+        n = max(min(len(b), self._size - self._pos), 0)
+        if n == 0:
+            return 0
+        with self._lock:
+            self._fileobj.seek(self._offset + self._pos)
+            data = self._fileobj.read(n)
+        memoryview(b).cast('B')[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class S3ObjectFile(io.RawIOBase):
+    """
+    Read-only, seekable file over an S3 object using HTTP range requests.
+    Reads are served from aligned blocks held in a small LRU cache so that
+    the many small, scattered reads made by h5py or zipfile stay cheap.
+    """
+
+    def __init__(self, obj, block_size: int = 4 * 2**20, max_blocks: int = 32):
+        self._obj = obj
+        self._size = obj.content_length
+        self._block_size = block_size
+        self._max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.name = 's3://{}/{}'.format(obj.bucket_name, obj.key)
+
+    @property
+    def size(self):
+        """Object size in bytes"""
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = pos
+        elif whence == io.SEEK_CUR:
+            self._pos += pos
+        elif whence == io.SEEK_END:
+            self._pos = self._size + pos
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+        return self._pos
+
+    def read_range(self, start: int, stop: int) -> bytes:
+        """Reads bytes [start, stop) directly from S3, bypassing the block cache"""
+        if stop <= start:
+            return b''
+        return self._obj.get(Range='bytes={}-{}'.format(start, stop - 1))['Body'].read()
+
+    def _get_block(self, i: int) -> bytes:
+        with self._lock:
+            if i in self._blocks:
+                self._blocks.move_to_end(i)
+                return self._blocks[i]
+        start = i * self._block_size
+        block = self.read_range(start, min(start + self._block_size, self._size))
+        with self._lock:
+            self._blocks[i] = block
+            while len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+    def readinto(self, b):
+        n = max(min(len(b), self._size - self._pos), 0)
+        if n == 0:
+            return 0
+        view = memoryview(b).cast('B')
+        if n > self._block_size * self._max_blocks // 2:
+            # Large reads go straight to S3 rather than churning the cache
+            view[:n] = self.read_range(self._pos, self._pos + n)
+        else:
+            filled = 0
+            while filled < n:
+                pos = self._pos + filled
+                i, offset = divmod(pos, self._block_size)
+                chunk = self._get_block(i)[offset:offset + n - filled]
+                view[filled:filled + len(chunk)] = chunk
+                filled += len(chunk)
+        self._pos += n
+        return n
+
+
+def zip_member_offset(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """Returns the offset of a member's data within the zip archive"""
+    zf.fp.seek(info.header_offset)
+    header = ZIP_LOCAL_HEADER.unpack(zf.fp.read(ZIP_LOCAL_HEADER.size))
+    assert header[0] == b'PK\x03\x04', 'Bad local file header for {}'.format(info.filename)
+    name_length, extra_length = header[-2:]
+    return info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+
+
+def zip_member_file(zf: zipfile.ZipFile, name: str) -> RangeFile:
+    """
+    Returns a seekable file over a stored (uncompressed) member of a zip
+    archive, reading directly from the archive without extracting it.
+    """
+    info = zf.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('{} is compressed and cannot be read in place'.format(name))
+    return RangeFile(zf.fp, zip_member_offset(zf, info), info.file_size, name=name)
+
+
+def iter_ranges(read_range, start: int, stop: int, chunk_size: int = 8 * 2**20, max_workers: int = 8):
+    """
+    Yields consecutive chunks of the byte range [start, stop) in order while
+    keeping up to max_workers chunk reads in flight.
+    :param read_range: Callable returning the bytes between two offsets, e.g. S3ObjectFile.read_range
+    """
+    bounds = iter([(s, min(s + chunk_size, stop)) for s in range(start, stop, chunk_size)])
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = deque(pool.submit(read_range, *b) for _, b in zip(range(max_workers), bounds))
+        while pending:
+            chunk = pending.popleft().result()
+            b = next(bounds, None)
+            if b is not None:
+                pending.append(pool.submit(read_range, *b))
+            yield chunk
+
+
+def iter_zip_member(zf: zipfile.ZipFile, name: str, chunk_size: int = 8 * 2**20, max_workers: int = 8):
+    """
+    Yields the uncompressed contents of a zip member in chunks. When the
+    archive is read from S3 the member is fetched in parallel range
+    requests; otherwise it is read through zipfile.
+    """
+    info = zf.getinfo(name)
+    ranged = hasattr(zf.fp, 'read_range')
+    if not ranged or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with zf.open(name) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+        return
+
+    start = zip_member_offset(zf, info)
+    decompressor = zlib.decompressobj(-15) if info.compress_type == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    for chunk in iter_ranges(zf.fp.read_range, start, start + info.compress_size, chunk_size, max_workers):
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        crc = zlib.crc32(chunk, crc)
+        yield chunk
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        crc = zlib.crc32(chunk, crc)
+        yield chunk
+    if crc != info.CRC:
+        raise zipfile.BadZipFile('Bad CRC-32 for file {}'.format(name))
+
+
+def _close_hdf(ref):
+    """Closes an HDF file if it is still open"""
+    hf = ref()
+    if hf is not None and hf.id.valid:
+        hf.close()
+
+
+def open_hdf(fileobj) -> 'h5py.File':
+    """
+    Opens an HDF file read-only from a seekable file object. The file is
+    closed at exit if still open, since h5py crashes when a Python file
+    object is torn down underneath an open file.
+    """
+    hf = h5py.File(fileobj, 'r')
+    atexit.register(_close_hdf, weakref.ref(hf))
+    return hf
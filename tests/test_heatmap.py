@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('h5py')
+pytest.importorskip('gdal')
+from rasterio.transform import from_origin
+from hecrasio.heatmap import HeatmapState, grid_run_id, heatmap_products_local
+
+ROWS, COLS, BLOCK = 96, 80, 32
+
+
+@pytest.fixture
+def grids(tmp_path):
+    """Tiled WSE grids with random dry cells and their weights"""
+    rng = np.random.RandomState(0)
+    paths, weights = [], {}
+    for i in range(6):
+        path = str(tmp_path / 'WSE_P06_E{:04d}.tif'.format(i))
+        wse = (rng.rand(ROWS, COLS) * 10 + 100).astype(np.float32)
+        wse[rng.rand(ROWS, COLS) < 0.3 + 0.1 * i] = -9999
+        # The last event is dry outside the first block, so only that window is rebuilt on removal
+        if i == 5:
+            wse[BLOCK:, :] = -9999
+            wse[:, BLOCK:] = -9999
+        profile = dict(driver='GTiff', height=ROWS, width=COLS, count=1, dtype='float32', nodata=-9999,
+                       crs='EPSG:3857', transform=from_origin(0, ROWS, 1, 1), tiled=True,
+                       blockxsize=BLOCK, blockysize=BLOCK)
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(wse, 1)
+        paths.append(path)
+        weights[grid_run_id(path)] = float(rng.rand()) / 6
+    return paths, weights
+
+
+def read_stacked(paths):
+    with rasterio.open(paths[0]) as src:
+        return src.read()
+
+
+def test_state_updates_match_rebuild(grids, tmp_path):
+    paths, weights = grids
+    state = HeatmapState(str(tmp_path / 'state'))
+    # Windows of a single block, so updates touch several windows
+    max_memory_gb = BLOCK * BLOCK * 60 / 1e9
+
+    def check(wse_grids, weights_dict, tag):
+        expected = heatmap_products_local(wse_grids, weights_dict, paths[0], 'rebuild_{}.tif'.format(tag),
+                                          str(tmp_path / 'out'), stacked=True)
+        result = state.write('state_{}.tif'.format(tag), str(tmp_path / 'out'), stacked=True)
+        np.testing.assert_allclose(read_stacked(result), read_stacked(expected), rtol=1e-6, atol=1e-6)
+
+    state.add_events(paths[:4], weights, max_memory_gb=max_memory_gb)
+    assert len(state.windows) > 1
+    check(paths[:4], weights, 1)
+
+    state.add_events(paths[4:], weights)
+    check(paths, weights, 2)
+
+    reweighted = dict(weights)
+    reweighted[grid_run_id(paths[1])] *= 3
+    state.reweight(reweighted)
+    check(paths, reweighted, 3)
+
+    state.remove_events([grid_run_id(paths[0]), grid_run_id(paths[5])])
+    check(paths[1:5], reweighted, 4)
+
+    state.update(paths[2:], weights)
+    check(paths[2:], weights, 5)
+    assert state.version == 5
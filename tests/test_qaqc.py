@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('pandas')
+from hecrasio.qaqc import reduce_tseries, tseries_blocks
+
+
+def reference(data, thresholds, absolute):
+    data = np.abs(data) if absolute else data
+    expected = {'max': data.max(axis=0), 'min': data.min(axis=0), 'argmax': data.argmax(axis=0)}
+    for t in thresholds:
+        above = data > t
+        steps = np.arange(len(data))[:, None]
+        expected['count_{}'.format(t)] = above.sum(axis=0)
+        expected['first_{}'.format(t)] = np.where(above.any(axis=0), above.argmax(axis=0), -1)
+        expected['last_{}'.format(t)] = np.where(above, steps, -1).max(axis=0)
+    return expected
+
+
+@pytest.fixture
+def tseries():
+    rng = np.random.RandomState(0)
+    data = rng.normal(0, 10, size=(23, 7)).astype(np.float32)
+    data[:, 0] = 0  # never exceeded
+    data[[2, 3, 17], 1] = 50  # exceeded in separate time blocks
+    return data
+
+
+@pytest.mark.parametrize('absolute', [False, True])
+def test_reduce_tseries_matches_numpy(tseries, absolute):
+    thresholds = [5, 20]
+    # 3 time steps per block, so exceedances span block boundaries
+    row_bytes = tseries.shape[1] * tseries.dtype.itemsize
+    max_memory_gb = 3 * row_bytes * 5 / 1e9
+    assert [len(block) for _, block in tseries_blocks(tseries, max_memory_gb, copies=4)][0] == 3
+
+    df = reduce_tseries(tseries, thresholds, absolute, max_memory_gb)
+    for column, values in reference(tseries, thresholds, absolute).items():
+        np.testing.assert_array_equal(df[column].values, values, err_msg=column)
+
+
+def test_reduce_tseries_hdf_dataset(tseries, tmp_path):
+    with h5py.File(str(tmp_path / 'results.hdf'), 'w') as hf:
+        ds = hf.create_dataset('Depth', data=tseries, chunks=(2, 7))
+        df = reduce_tseries(ds, [20], max_memory_gb=5 * 28 * 5 / 1e9)
+        expected = reduce_tseries(tseries, [20])
+    assert df.equals(expected)
+    assert list(df.columns) == ['max', 'min', 'argmax', 'count_20', 'first_20', 'last_20']
+
+
+def test_reduce_tseries_without_thresholds(tseries):
+    df = reduce_tseries(tseries, max_memory_gb=1e-7)
+    assert list(df.columns) == ['max', 'min', 'argmax']
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('pandas')
+from hecrasio.store import QAQCStore
+
+MODEL = 's3://pfra/DC/P01/H06/E{0:04d}/DC_P01_H06_E{0:04d}_out.zip'
+
+
+def test_append_adds_columns_first_seen_as_none(tmp_path):
+    store = QAQCStore(str(tmp_path / 'qaqc.db'))
+    store.append([{'Model': MODEL.format(1), '1D Cores': 4, 'Max Velocity': None}])
+    store.append([{'Model': MODEL.format(2), '1D Cores': 4, 'Max Velocity': 2.5, 'Note': None}])
+
+    df = store.load()
+    assert {'Max Velocity', 'Note'} <= set(df.columns)
+    assert df.loc['DC_P01_H06_E0001', 'Max Velocity'] is None
+    assert df.loc['DC_P01_H06_E0002', 'Max Velocity'] == '2.5'
+    assert list(df['ModelID'].unique()) == ['P01']
+    store.close()
+
+
+def test_append_types_columns_by_first_value(tmp_path):
+    store = QAQCStore(str(tmp_path / 'qaqc.db'))
+    store.append([{'Model': MODEL.format(1), 'Max Velocity': None},
+                  {'Model': MODEL.format(2), 'Max Velocity': 2.5, 'Global Errors': ['Failed']}])
+
+    df = store.load()
+    assert df.loc['DC_P01_H06_E0002', 'Max Velocity'] == 2.5
+    assert df.loc['DC_P01_H06_E0002', 'Global Errors'] == ['Failed']
+    assert df.loc['DC_P01_H06_E0001', 'Global Errors'] == []
+    store.close()
+
+
+def test_append_replaces_rerun(tmp_path):
+    store = QAQCStore(str(tmp_path / 'qaqc.db'))
+    store.append([{'Model': MODEL.format(1), '1D Cores': None}])
+    store.append([{'Model': MODEL.format(1), '1D Cores': 4}])
+
+    df = store.table()
+    assert list(df.index) == ['DC_P01_H06_E0001']
+    assert 'Model' not in df.columns
+    store.close()